@@ -89,11 +89,41 @@ def how_to_md(dcc):
         show you the currently selected ONI range. To view the entirety of the data for the chosen
         station, select the extreme ends of the range slider to encompass all ENSO conditions.
 
+        ###### Analog Years
+        Checking *Show analog years?* highlights the five past years whose snow water equivalent so far this
+        season is closest to the current year's at the selected station, along with the range those years
+        covered over the rest of the season. *Weight analogs by ONI?* favours years with an ONI close to this year's.
+
         ###### The Map
         To select a station, zoom in to a station symbol of interest and click on it. The click will
         cause the graph to plot the data for that station and highlight the station in red. There
         are four button controls in the upper right corner of the map that allow downloading an
-        image of the current map, zooming in, zooming out or resetting the axes.
+        image of the current map, zooming in, zooming out or resetting the axes. A station can also be chosen
+        by typing its ID, part of its name or a "latitude, longitude" pair into the search box above the map,
+        or by linking to the page with *?station=3A25P* or *?lat=49.7&lon=-123.1* for the nearest station.
+
+        ###### The Anomaly Date Scrubber
+        When station anomalies are plotted, the slider and year menu below the map choose the date shown.
+        The slider picks the day of the water year and the menu picks the water year, so the same day
+        can be compared across past years. The *Play* button steps through the season one day at a time.
+        The stations can be coloured by percent of normal or by the percentile rank of the day's snow water
+        equivalent among all complete years of record, or among the years in the selected ENSO range. The
+        hover text also gives the exceedance probability, the chance of a year having had more snow on that day.
+        The two *ENSO median* options colour each station by how the median snow water equivalent of the years
+        in the selected ENSO range compares with its full-record median, on the scrubber's day of the water year
+        or at the annual peak, and follow the ENSO slider as it moves. Stations with fewer than five complete
+        years in the range are left uncoloured.
+        The three *trend* options colour each station by its long-term trend over its complete years of record:
+        the change in annual peak snow water equivalent as a percentage of the station's median peak per decade,
+        or the change in the date of the peak or of melt-out (the first day after the peak with no snow) in days
+        per decade. The
+        trends are Theil-Sen slopes, the median of the slopes between every pair of years, so a single
+        extreme year moves them little. The hover text gives the Mann-Kendall p value of each trend; values
+        above about 0.05 mean the trend could well be chance. Stations with fewer than ten complete years have no trend.
+        Checking *Interpolated surface?* along with the anomalies shades the map between the stations with the
+        same colouring, spread from the stations by inverse distance weighting and adjusted for the stations'
+        elevations. The surface reaches 100 km from the nearest station and shows conditions at a typical
+        station elevation, so treat it as a guide to the regional pattern rather than a value for any one valley.
 
         ###### The Graph
         What is plotted on the graph is dictated by the other app elements and can also be controlled by
@@ -104,6 +134,15 @@ def how_to_md(dcc):
         can both be zoomed into to modify the range of what is plotted. Additional controls in the upper right of
         the graph alow one to download an image of the current plot, reset the axes or choose a graph
         selection method.
+        On narrow screens such as phones the range, quantile and individual year curves are drawn with fewer
+        points to keep the chart quick to load, keeping the peaks and melt-out that shape each curve. Zooming
+        into the graph redraws them with every day; double clicking to reset the axes thins them again.
+
+        ###### ENSO Summary by Station
+        The *Summarize stations* button on the Analysis tab builds a table of every station passing the checklist,
+        comparing the median peak snow water equivalent, the date of that peak and the melt-out date in the years
+        picked on the ENSO slider against the full record. It takes a few seconds, so it runs in the background
+        with a progress bar and can be stopped with *Cancel*; the map and graph stay usable meanwhile.
         '''
     )
 
@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+import urllib.request
+import urllib.error
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Load-testing harness for the snow app.
+
+Starts the app under gunicorn against the local snow/ files (SNOWAPP_DATA_DIR, so no network
+access is needed) and has a number of simulated sessions replay the _dash-update-component
+requests a user makes: dragging the ONI slider one 0.1 step at a time, picking stations and
+toggling the map options. Reports throughput, p50/p95/p99 latency per callback and the
+resident memory of the gunicorn workers.
+
+The request bodies are built from the app's own /_dash-dependencies and /_dash-layout, so the
+harness follows changes to the callback signatures. Only the inputs a session moves are set
+here; every other input and state takes its initial value from the layout.
+
+For realistic numbers put a copy of SW_DailyArchive.csv in the data directory, otherwise only
+the current year's SWDaily.csv is loaded.
+
+Example:
+    python loadtest.py --workers 2 --threads 4 --concurrency 50 --duration 60
+'''
+
+#The callbacks sessions exercise, by the component property they write
+LINE_CHART_OUTPUT = 'snow-station-graph.figure'
+STATION_MAP_OUTPUT = 'snow-station-map.figure'
+
+def post_json(url,body,timeout=60):
+    request = urllib.request.Request(url,data=json.dumps(body).encode(),headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request,timeout=timeout) as response:
+        return response.status, response.read()
+
+def get_json(url,timeout=60):
+    with urllib.request.urlopen(url,timeout=timeout) as response:
+        return json.loads(response.read())
+
+def layout_props(layout,props=None):
+    #Walk the layout tree collecting the props of every component with an id
+    props = {} if props is None else props
+    if isinstance(layout,list):
+        for child in layout:
+            layout_props(child,props)
+    elif isinstance(layout,dict):
+        if 'props' in layout:
+            if 'id' in layout['props']:
+                props[layout['props']['id']] = layout['props']
+            layout_props(layout['props'].get('children'),props)
+        else:
+            for value in layout.values():
+                layout_props(value,props)
+    return props
+
+def load_callbacks(baseurl):
+    #The app's callback dependencies and the initial props of its components
+    return {
+        'baseurl': baseurl,
+        'dependencies': get_json(baseurl+'/_dash-dependencies'),
+        'props': layout_props(get_json(baseurl+'/_dash-layout')),
+    }
+
+def dependency_outputs(dependency):
+    #The 'id.property' outputs of a callback; several are written as ..a.b...c.d..
+    return dependency['output'].strip('.').split('...')
+
+def callback_body(callbacks,output,values,changed):
+    '''
+    Build the _dash-update-component body for the callback writing output (the primary one,
+    not an allow_duplicate one). values maps 'id.property' to the inputs and states to set;
+    the rest come from the layout.
+    '''
+    dependency = [dependency for dependency in callbacks['dependencies'] if output in dependency_outputs(dependency)][0]
+    def value(item):
+        key = '{}.{}'.format(item['id'],item['property'])
+        if key in values:
+            return values[key]
+        return callbacks['props'].get(item['id'],{}).get(item['property'])
+    outputs = [dict(zip(['id','property'],item.split('.',1))) for item in dependency_outputs(dependency)]
+    return {
+        'output': dependency['output'],
+        'outputs': outputs if len(outputs) > 1 else outputs[0],
+        'inputs': [dict(item,value=value(item)) for item in dependency['inputs']],
+        'state': [dict(item,value=value(item)) for item in dependency['state']],
+        'changedPropIds': [changed],
+    }
+
+def call_callback(callbacks,output,values,changed):
+    #Returns (callback output, seconds, ok, response), the response being {} when there is none
+    starttime = time.perf_counter()
+    response = {}
+    try:
+        status, content = post_json(callbacks['baseurl']+'/_dash-update-component',callback_body(callbacks,output,values,changed))
+        ok = status in (200, 204)
+        if status == 200:
+            response = json.loads(content).get('response',{})
+    except (urllib.error.URLError, OSError):
+        ok = False
+    return output, time.perf_counter()-starttime, ok, response
+
+def station_ids(callbacks):
+    #Station IDs from the hover data of a full map draw
+    body = callback_body(callbacks,STATION_MAP_OUTPUT,{'record-length-current-check.value': []},'record-length-current-check.value')
+    status, content = post_json(callbacks['baseurl']+'/_dash-update-component',body)
+    figure = json.loads(content)['response']['snow-station-map']['figure']
+    return sorted({point[1] for point in figure['data'][0]['customdata']})
+
+def run_session(callbacks,stations,stoptime,seed,viewportwidth=None):
+    '''
+    One simulated user: pick a station, drag an ONI slider handle across a few steps, now and
+    then toggle the map anomalies or record filter. viewportwidth is the browser width in
+    pixels, None for a full resolution chart. Returns the (callback, seconds, ok) records.
+    '''
+    rng = random.Random(seed)
+    records = []
+    values = {'selected-station.data': rng.choice(stations), 'session-id.data': 'loadtest-{}'.format(seed), 'viewport-width.data': viewportwidth}
+    while time.time() < stoptime:
+        values['selected-station.data'] = rng.choice(stations)
+        output, seconds, ok, response = call_callback(callbacks,LINE_CHART_OUTPUT,values,'selected-station.data')
+        records.append((output, seconds, ok))
+        #Carry the chart state forward like the browser does, so repeat year sets are skipped
+        values['line-chart-state.data'] = response.get('line-chart-state',{}).get('data',values.get('line-chart-state.data'))
+
+        #Slider drag with updatemode='drag' sends a request per 0.1 step
+        lower = round(rng.uniform(-3,0),1)
+        upper = round(rng.uniform(0,3),1)
+        for step in range(rng.randint(3,15)):
+            if time.time() >= stoptime:
+                break
+            upper = round(min(upper+0.1,3),1)
+            values['oni-range-slider.value'] = [lower,upper]
+            output, seconds, ok, response = call_callback(callbacks,LINE_CHART_OUTPUT,values,'oni-range-slider.value')
+            records.append((output, seconds, ok))
+            values['line-chart-state.data'] = response.get('line-chart-state',{}).get('data',values.get('line-chart-state.data'))
+
+        if rng.random() < 0.3:
+            values['show-anoms-stat.value'] = rng.choice([[],['anomstat']])
+            values['record-length-current-check.value'] = rng.choice([['rcy'],['rcy','rtmy'],[]])
+            records.append(call_callback(callbacks,STATION_MAP_OUTPUT,values,'show-anoms-stat.value')[0:3])
+    return records
+
+def worker_pids(masterpid):
+    #Children of the gunicorn master
+    try:
+        output = subprocess.run(['pgrep','-P',str(masterpid)],capture_output=True,text=True).stdout
+    except FileNotFoundError:
+        with open('/proc/{0}/task/{0}/children'.format(masterpid)) as childfile:
+            output = childfile.read().replace(' ','\n')
+    return [int(pid) for pid in output.split()]
+
+def rss_mb(pid):
+    #Resident set size of a process in MB from /proc, falling back to ps
+    try:
+        with open('/proc/{}/status'.format(pid)) as statusfile:
+            for line in statusfile:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    output = subprocess.run(['ps','-o','rss=','-p',str(pid)],capture_output=True,text=True).stdout.strip()
+    return int(output)/1024 if output else np.nan
+
+def sample_rss(masterpid,stopevent,peaks,interval=0.5):
+    #Track the peak RSS of each worker until stopevent is set
+    while not stopevent.is_set():
+        for pid in worker_pids(masterpid):
+            peaks[pid] = max(peaks.get(pid,0),rss_mb(pid))
+        stopevent.wait(interval)
+
+def start_server(args):
+    '''
+    Launch gunicorn on snowapp:server with the requested worker and thread counts and wait for
+    the app to answer. Returns the process.
+    '''
+    env = dict(os.environ,SNOWAPP_DATA_DIR=os.path.abspath(args.data_dir))
+    command = [
+        sys.executable,'-m','gunicorn','snowapp:server',
+        '--bind','127.0.0.1:{}'.format(args.port),
+        '--workers',str(args.workers),
+        '--threads',str(args.threads),
+        '--timeout','300',
+    ]
+    server = subprocess.Popen(command,env=env,cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+    deadline = time.time()+args.startup_timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('gunicorn exited with code {}'.format(server.returncode))
+        try:
+            get_json('http://127.0.0.1:{}/_dash-dependencies'.format(args.port),timeout=5)
+            return server
+        except (urllib.error.URLError, OSError):
+            time.sleep(1)
+    server.terminate()
+    raise RuntimeError('The app did not start within {} s'.format(args.startup_timeout))
+
+def summarize(records,elapsed,peaks):
+    #Throughput and latency percentiles overall and by callback
+    report = {'elapsed_s': elapsed, 'requests': len(records), 'callbacks': {}}
+    groups = {'all': records}
+    for record in records:
+        groups.setdefault(record[0],[]).append(record)
+    for name, group in groups.items():
+        latencies = 1000*np.array([record[1] for record in group])
+        report['callbacks'][name] = {
+            'requests': len(group),
+            'errors': sum(not record[2] for record in group),
+            'throughput_rps': len(group)/elapsed,
+            'p50_ms': float(np.percentile(latencies,50)) if len(group) else np.nan,
+            'p95_ms': float(np.percentile(latencies,95)) if len(group) else np.nan,
+            'p99_ms': float(np.percentile(latencies,99)) if len(group) else np.nan,
+        }
+    report['worker_peak_rss_mb'] = {str(pid): peak for pid, peak in peaks.items()}
+    report['total_peak_rss_mb'] = float(sum(peaks.values()))
+    return report
+
+def print_report(report,args):
+    print('Workers: {} Threads: {} Concurrency: {} Duration: {:.1f} s'.format(
+        args.workers,args.threads,args.concurrency,report['elapsed_s']))
+    print('{:<30}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}'.format('callback','requests','errors','req/s','p50 ms','p95 ms','p99 ms'))
+    for name, stats in report['callbacks'].items():
+        print('{:<30}{:>10}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+            name,stats['requests'],stats['errors'],stats['throughput_rps'],stats['p50_ms'],stats['p95_ms'],stats['p99_ms']))
+    for pid, peak in report['worker_peak_rss_mb'].items():
+        print('worker {} peak RSS {:.0f} MB'.format(pid,peak))
+    print('total peak RSS {:.0f} MB'.format(report['total_peak_rss_mb']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay Dash callback traffic against the snow app.')
+    parser.add_argument('--workers',type=int,default=1,help='gunicorn worker processes')
+    parser.add_argument('--threads',type=int,default=1,help='gunicorn threads per worker')
+    parser.add_argument('--concurrency',type=int,default=10,help='simultaneous simulated sessions')
+    parser.add_argument('--duration',type=float,default=30.,help='seconds of load')
+    parser.add_argument('--port',type=int,default=8050)
+    parser.add_argument('--data-dir',default='./snow',help='directory with SWDaily.csv, oni.ascii.txt and optionally SW_DailyArchive.csv')
+    parser.add_argument('--url',default=None,help='load an already running app instead of starting one (no RSS report)')
+    parser.add_argument('--startup-timeout',type=float,default=300.)
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--viewport-width',type=int,default=None,help='browser width in pixels the sessions report, e.g. 390 for a phone')
+    parser.add_argument('--json',default=None,help='also write the report to this file')
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.url is None:
+        server = start_server(args)
+        baseurl = 'http://127.0.0.1:{}'.format(args.port)
+    else:
+        baseurl = args.url.rstrip('/')
+
+    peaks = {}
+    stopevent = threading.Event()
+    try:
+        callbacks = load_callbacks(baseurl)
+        stations = station_ids(callbacks)
+        if server is not None:
+            sampler = threading.Thread(target=sample_rss,args=(server.pid,stopevent,peaks),daemon=True)
+            sampler.start()
+        starttime = time.time()
+        stoptime = starttime+args.duration
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            sessions = [pool.submit(run_session,callbacks,stations,stoptime,args.seed+k,args.viewport_width) for k in range(args.concurrency)]
+            records = [record for session in sessions for record in session.result()]
+        elapsed = time.time()-starttime
+    finally:
+        stopevent.set()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = summarize(records,elapsed,peaks)
+    print_report(report,args)
+    if args.json is not None:
+        with open(args.json,'w') as jsonfile:
+            json.dump(report,jsonfile,indent=2)
+    return report
+
+if __name__ == '__main__':
+    main()
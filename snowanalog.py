@@ -0,0 +1,47 @@
+import numpy as np
+
+'''
+Analog years for the current season: the past water years whose SWE so far this season most
+closely follows the current year's, station by station.
+
+Distances are the root mean square difference over the days of the water year to date that
+both years have data for, computed for every station and year at once from the (station x
+year x day) cube of build_year_cube. Only complete years can be analogs so that they carry a
+rest of season. The distance can be weighted toward years with a similar ONI by multiplying it
+by (1 + oniweight * |ONI difference|).
+'''
+
+#Share of the days to date that a past year must have data on to be compared
+ANALOG_MIN_OVERLAP = 0.5
+ANALOG_COUNT = 5
+#Weight used for the app's ONI-weighted analogs: a 1 degree ONI difference doubles the distance
+ANALOG_ONI_WEIGHT = 1.
+
+def analog_distances(yearcube,currentyear,dayidx,teleseries=None,oniweight=0.):
+    '''
+    Distance of every (station, year) trajectory from the currentyear trajectory over days 0 to
+    dayidx. teleseries is the per-water-year ONI used for weighting. Years that cannot be
+    analogs have an infinite distance.
+    '''
+    years = yearcube['years']
+    current = yearcube['values'][:,years == currentyear,0:dayidx+1]
+    past = yearcube['values'][:,:,0:dayidx+1]
+
+    squared = (past-current)**2
+    overlap = (~np.isnan(squared)).sum(axis=2)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        distances = np.sqrt(np.nansum(squared,axis=2)/overlap)
+    distances[(overlap < ANALOG_MIN_OVERLAP*(dayidx+1)) | ~yearcube['complete']] = np.inf
+    distances[:,years == currentyear] = np.inf
+
+    if (teleseries is not None) and (oniweight > 0) and (currentyear in teleseries.index):
+        onidiff = np.abs(teleseries.reindex(years).to_numpy(dtype=float)-teleseries[currentyear])
+        #Years without an ONI value are left unweighted
+        distances = distances*(1+oniweight*np.nan_to_num(onidiff,nan=0.))[None,:]
+    return distances
+
+def top_analogs(distances,years,stationidx,count=ANALOG_COUNT):
+    #The count closest years for one station, closest first
+    stationdistances = distances[stationidx]
+    order = np.argsort(stationdistances,kind='stable')[0:count]
+    return years[order[np.isfinite(stationdistances[order])]]
@@ -0,0 +1,93 @@
+import numpy as np
+from pandas import date_range
+from snowplot import MAXDAYIDX
+
+'''
+Compact (station x date) store of the percent-of-normal snow anomalies for the map's date
+scrubber. The anomalies are held as int16 whole percent with ANOM_MISSING for gaps, and a
+(water year x day of water year) table gives the column for any date, so moving the scrubber
+costs one lookup and one slice rather than a recompute.
+'''
+
+ANOM_MISSING = np.iinfo(np.int16).min
+
+def wateryear_days():
+    '''
+    The month-day strings from 1 October through 30 September (no 29 February), the same order
+    the station pivot uses for the line chart.
+    '''
+    return list(date_range('2001-10-01','2002-09-30').strftime('%m-%d'))
+
+def build_year_cube(df,stations):
+    '''
+    Scatter the station columns of the snow dataframe into a (station x water year x day of
+    water year) array. complete marks the years with more than 95% of the first MAXDAYIDX days,
+    the same test the line chart uses for its quantiles.
+    '''
+    days = wateryear_days()
+    dayindex = {day: k for k, day in enumerate(days)}
+    rowdays = np.array([dayindex[day] for day in df['month-day']])
+    rowyears = df['hydrological_year'].to_numpy(dtype=int)
+    years = np.arange(rowyears.min(),rowyears.max()+1)
+
+    values = np.full((len(stations),len(years),len(days)),np.nan)
+    values[:,rowyears-years[0],rowdays] = df[list(stations)].to_numpy(dtype=float).T
+    complete = (1-np.isnan(values[:,:,0:MAXDAYIDX]).sum(axis=2)/MAXDAYIDX) > 0.95
+
+    return {
+        'values': values,
+        'complete': complete,
+        'years': years,
+        'days': days,
+        'stations': {stnname: k for k, stnname in enumerate(stations)},
+    }
+
+def build_anomaly_array(snow_pct_median,wateryears,monthdays):
+    '''
+    snow_pct_median is the (date x station) percent of normal dataframe, wateryears and
+    monthdays the hydrological year and month-day of each of its rows.
+    '''
+    values = snow_pct_median.to_numpy(dtype=float).T
+    encoded = np.full(values.shape,ANOM_MISSING,dtype=np.int16)
+    havedata = ~np.isnan(values)
+    encoded[havedata] = np.round(values[havedata])
+
+    wateryears = np.asarray(wateryears,dtype=int)
+    days = wateryear_days()
+    dayindex = {day: k for k, day in enumerate(days)}
+    years = np.arange(wateryears.min(),wateryears.max()+1)
+    position = np.full((len(years),len(days)),-1,dtype=np.int32)
+    position[wateryears-years[0],[dayindex[day] for day in monthdays]] = np.arange(len(wateryears))
+
+    return {
+        'values': encoded,
+        'position': position,
+        'years': years,
+        'days': days,
+        'stations': {stnname: k for k, stnname in enumerate(snow_pct_median.columns)},
+    }
+
+def latest_anomaly_date(anomarray):
+    #The water year and day index of the most recent column, which is what the map shows by default
+    yearidx, dayidx = np.unravel_index(np.argmax(anomarray['position']),anomarray['position'].shape)
+    return int(anomarray['years'][yearidx]), int(dayidx)
+
+def date_row(anomarray,wateryear,dayidx):
+    #Row of the snow dataframe for the water year and day of water year, None if there is none
+    yearidx = int(wateryear) - anomarray['years'][0]
+    if (yearidx < 0) or (yearidx >= len(anomarray['years'])) or (anomarray['position'][yearidx,dayidx] < 0):
+        return None
+    return anomarray['position'][yearidx,dayidx]
+
+def anomaly_on_date(anomarray,wateryear,dayidx,stations):
+    '''
+    Percent of normal for the named stations on the given water year and day of water year.
+    All NaN if there are no data for that date.
+    '''
+    rows = [anomarray['stations'][stnname] for stnname in stations]
+    daterow = date_row(anomarray,wateryear,dayidx)
+    if daterow is None:
+        return np.full(len(rows),np.nan)
+    pct = anomarray['values'][rows,daterow].astype(float)
+    pct[pct == ANOM_MISSING] = np.nan
+    return pct
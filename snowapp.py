@@ -11,15 +11,33 @@
 
 import pandas as pd
 import numpy as np
-from dash import Dash, html, dcc, Input, Output, callback, State
+import os
+import diskcache
+from dash import Dash, html, dcc, dash_table, Input, Output, callback, State, Patch, ctx, no_update, DiskcacheManager
+from dash.exceptions import PreventUpdate
 import plotly.graph_objects as go
 import dash_bootstrap_components as dbc
 from datetime import datetime
+from urllib.parse import parse_qs
 import time
-from snowdata import get_wyear_extrema_oni, get_oni_startrange, load_munge_snow_data, count_coverage, get_median
+import flask
+from functools import lru_cache
+from snowdata import get_wyear_extrema_oni, get_oni_startrange, prepare_snow_data, count_coverage, get_median
+from snowdata import get_teleconnection_table, build_year_bitsets, select_years_bitmask, years_from_bitmask, pivot_station_years, data_version
 from documentation import how_to_md, analysis_desc_md, header_text_md, footer_text_md
-from snowmap import draw_station_map
-from snowplot import snow_lineplot
+from snowmap import draw_station_map, station_marker, MAP_COLOUR_MODES, MAP_CUSTOMDATA
+from snowprecompute import DERIVED_DATA_FILE, load_derived_data, precompute_derived
+from snowanomaly import build_anomaly_array, latest_anomaly_date, anomaly_on_date, date_row, build_year_cube
+from snowrank import build_rank_table, rank_swe
+from snowstations import build_station_index, lookup_station, nearest_stations, search_stations
+from snowcomposite import build_composite_table, enso_composite
+from snowsurface import idw_surface, surface_rgba, render_tile
+from snowanalog import analog_distances, top_analogs, ANALOG_ONI_WEIGHT
+from snowplot import snow_lineplot, snow_lineplot_patch, snow_lineplot_restyle, snow_lineplot_resolution, full_quantiles, lod_rows, selected_quantiles, MAXDAYIDX, TARGET_QUANTILES
+from snowlod import lod_points
+from snowcoalesce import begin_request, superseded
+from snowbands import QUANTILE_BANDS_FILE, load_quantile_bands, lookup_quantile_bands
+from snowsummary import network_summary, SUMMARY_COLUMNS
 
 '''
 Author: Faron Anslow
@@ -43,7 +61,7 @@ NAO data URL: https://www.cpc.ncep.noaa.gov/products/precip/CWlink/pna/norm.nao.
 All teleconnections in one! ftp://ftp.cpc.ncep.noaa.gov/wd52dg/data/indices/tele_index.nh
 '''
 
-df, stations_with_current_year = load_munge_snow_data()
+df, locdf, stations_with_current_year = prepare_snow_data()
 
 #lets figure out how to make quantiles for each station/day and 
 #compute the percentile amount relative to median for all stations.
@@ -53,112 +71,73 @@ df, stations_with_current_year = load_munge_snow_data()
 #We only need the median outside of the line plotting function, 
 #so we can save the full quantile calculation for there. 
 
-#Filter the location file by what's in the data file and vice versa so that there is 1:1
-#correspondence between the meta data file and the data file. Let's do this on the location ID
-#locdf
-datastnids = pd.Series([i.split(' ',1)[0] for i in df.columns.to_list()])
-datastnnames = pd.Series([i.split(' ',1)[1] for i in df.columns.to_list()])
-
-#Bring in the station meta data
-locdf = pd.read_csv('./snow/SNW_ASWS.csv')
-metastnids = locdf['LCTN_ID']
-datastnnames = datastnnames[datastnids.isin(metastnids)]
-datastnids = datastnids[datastnids.isin(metastnids)]
-metastnids = metastnids[metastnids.isin(datastnids)]
-
-#re-subset the dataframes so that the stations match one for one
-df = df.loc[:,(datastnids+' '+datastnnames)]
-locdf = locdf.loc[locdf['LCTN_ID'].isin(metastnids),:]
-#if ~(stations_with_current_year.isin(datastnids+' '+datastnnames).all()):
-#    raise
-
-locdf['text'] = locdf['LCTN_ID'] + ' ' + locdf['LCTN_NM'] + '<br>Elevation: ' + (locdf['ELEVATION']).astype(str)
-
-# Make a column formatted that gives the hydrological year. Essentially the time index, forward by 3 months,
-# then reformatted to %Y using strftime.
-def datetimepandas(timestamp,theformat):
-    return datetime.strftime(timestamp,theformat)
-def hydrodoy_from_timestamp(timestamps):
-    """
-    This function takes a pandas data Series object of timestamps and converts it into the day of the hydrological
-    year which starts on 1 October and runs through the end of September. Returns a pandas Series of those days of year.
-
-    Leap years are accommodated in an ugly way through making masks on the vector. I'm sure there are more elegant ways
-    of doing this!
-    """
-    #Calculating the julian day is the first, necessary step.
-    hydrodoy = timestamps.apply(datetimepandas,args=('%j',)).astype(int)
-    #Next, need to link logic to operate one way for years where YEAR % 4 == 0 and anotherway for years where YEAR % 4 ~= 0
-    leapmask = timestamps.apply(datetime.strftime,args=('%Y',)).astype(int) % 4 == 0
-    hydrodoy = hydrodoy - 273
-    hydrodoy.loc[leapmask] = hydrodoy.loc[leapmask] - 1 #Adjust for the leap year
-    negleapmask = leapmask & (hydrodoy < 1)
-    hydrodoy = hydrodoy.mask(hydrodoy < 1, hydrodoy+365) #Correct the days of the year prior to 1 October back to their order
-    hydrodoy.loc[negleapmask] = hydrodoy.loc[negleapmask] + 1 #Adjust for the leap year
-    return hydrodoy
-
-def wateryear_from_timestamps(timestamps):
-    """
-    This function takes a pandas data Series object of timestamps and determines the hydrological year the date
-    belongs to. Essentially, has to look at the year 92 days in the future.
-
-    Needs error trapping or at least some type checking.
-    """
-    wateryears = timestamps + pd.Timedelta("92 day")
-    wateryears = wateryears.apply(datetimepandas,args=('%Y',))
-    wateryears = wateryears.astype(int)
-    return wateryears
-
-# ## Station Snow Statistics
-#
-# Interested in being able to correlate ENSO with timing of peak snow and amount of snow at the peak. Also interested in magnitude of peak melt rate and timing of the peak melt rate. These satistics will be part of a map-based view of the station data that will be colourized by the level of correlation or by the percent of peak snow associated with the
-df['hydrodoy'] = hydrodoy_from_timestamp(df.index.to_series())
-df['hydrological_year'] = wateryear_from_timestamps(df.index.to_series())
-
-#Add on the month-day column for better plotting
-df['month-day'] = df.index.strftime('%m-%d')
-#Drop all leap years
-df = df.loc[(~(df['month-day']=='02-29')),:]
-
-#pd.set_option('display.max_rows', 150)
-#Find the number of years with more than 80% data coverage.
-nyears_complete = (df.groupby(by="hydrological_year").apply(count_coverage,include_groups=False)*100/365 > 80).sum(axis='rows')
-nyears_complete = nyears_complete[:-2]
-#Get the peak snow each year:
-peak_annual_snow = df.iloc[:,:-1].groupby(by="hydrological_year").max()
-peak_annual_snow = peak_annual_snow.iloc[:,:-1]
-historical_median_snow = df.iloc[:,:-2].groupby(by="hydrodoy").mean()
-
-#peak_annual_snow
-dftest = df.copy()
-#keep the index
-dates = df.index
-dftest = dftest.set_index(['hydrodoy'],append=True).iloc[:,:-2]
-historical_median_snow = dftest.rolling(window=5,center=True).mean().groupby(level=1).mean()
-
-#dftest = dftest.iloc[:,:-3]
-dftest.sort_index(level=['hydrodoy'])
-#pd.set_option('display.max_rows', None)
-#dftest.loc[(slice(None),1),:]
-pd.set_option('display.max_rows', 30)
-snow_pct_median = 100*(dftest/historical_median_snow)
-snow_pct_median.replace([np.inf], 399, inplace=True)
-snow_pct_median[snow_pct_median > 399] = 400
+#Derived data come from the precompute artifact when it matches the data, otherwise they are
+#computed here, sharded by station over SNOWAPP_PRECOMPUTE_WORKERS processes.
+#Tag of the loaded data for the artifacts and caches built from it
+dataversion = data_version(df)
+derived = load_derived_data(DERIVED_DATA_FILE,dataversion)
+if derived is None:
+    derived = precompute_derived(df)
+nyears_complete = derived['nyears_complete']
+peak_annual_snow = derived['peak_annual_snow']
+historical_median_snow = derived['historical_median_snow']
+snow_pct_median = derived['snow_pct_median']
 snow_pct_now = snow_pct_median.iloc[-1:,].reset_index(drop=True).T #=range(126) #= snow_pct_median.iloc[-1:,].T
 
 
 #check to see if we have a 1:1 match of the current snow percentage with the locations dataframe
-if (snow_pct_now.index == locdf['LCTN_ID'] + ' ' + locdf['LCTN_NM']).all():
+if (snow_pct_now.index == locdf['DATA_COLUMN']).all():
     locdf['pct_snow'] = snow_pct_now.iloc[:,0].values
 else:
     None
 
+#Long-term trends for the map: peak SWE in % of the median peak per decade and the peak date and
+#melt-out in days per decade, all Theil-Sen slopes with their Mann-Kendall p values
+peak_trend = derived['peak_trend'].reindex(locdf['DATA_COLUMN'])
+peak_day_trend = derived['peak_day_trend'].reindex(locdf['DATA_COLUMN'])
+snowoff_trend = derived['snowoff_trend'].reindex(locdf['DATA_COLUMN'])
+with np.errstate(invalid='ignore',divide='ignore'):
+    locdf['trend_peak'] = (1000*peak_trend['slope']/peak_trend['median']).replace([np.inf,-np.inf],np.nan).to_numpy()
+locdf['trend_peak_p'] = peak_trend['p'].to_numpy()
+locdf['trend_peakday'] = (10*peak_day_trend['slope']).to_numpy()
+locdf['trend_peakday_p'] = peak_day_trend['p'].to_numpy()
+locdf['trend_melt'] = (10*snowoff_trend['slope']).to_numpy()
+locdf['trend_melt_p'] = snowoff_trend['p'].to_numpy()
+
+#Spatial index and ID lookup for resolving clicks, URL parameters and searches to stations
+stationindex = build_station_index(locdf)
+defaultstation = '3A25P'
+
+#Compact station x date store of the anomalies behind the map's date scrubber
+anomarray = build_anomaly_array(snow_pct_median,df['hydrological_year'],df['month-day'])
+latestanomyear, latestanomday = latest_anomaly_date(anomarray)
+
 mnxonidata = get_wyear_extrema_oni()
 startrange = get_oni_startrange(mnxonidata)
+#Per-water-year table of the teleconnection indices used for selecting years and the bitsets
+#that turn a slider range into a set of years. Add 'PNA' or 'NAO' here to select on them too.
+teletable = get_teleconnection_table(['ONI'])
+telebitsets = build_year_bitsets(teletable)
+#Quantile bands precomputed for every ENSO subset by `python snowbands.py`. None if the file
+#has not been built for the current data, in which case the quantiles are computed per request.
+quantilebands = load_quantile_bands(QUANTILE_BANDS_FILE,dataversion)
 
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 currentyear = df[['hydrological_year']].max()
+#Presorted complete-year SWE for ranking each station's SWE on the scrubber date
+stationcolumns = df.columns[:-3].to_list()
+swevalues = df[stationcolumns].to_numpy(dtype=float)
+yearcube = build_year_cube(df,stationcolumns)
+ranktable = build_rank_table(yearcube,currentyear.iloc[0])
+#Full-record medians behind the ENSO-composite map colouring
+compositetable = build_composite_table(yearcube,currentyear.iloc[0])
+#Distances of every station's past years from the current year to date, plain and ONI weighted.
+#The current year's data don't change while the app runs, so these are done once.
+analogdistances = {
+    False: analog_distances(yearcube,currentyear.iloc[0],latestanomday),
+    True: analog_distances(yearcube,currentyear.iloc[0],latestanomday,teletable['ONI'],ANALOG_ONI_WEIGHT),
+}
 fillninoarea = 'rgba(255,110,95,0.3)'
 fillninoline = 'rgb(255,110,95)'
 fillninaarea = 'rgba(0,175,245,0.3)'
@@ -178,8 +157,17 @@ COLORS = {
     'text': '#292F36',         # Text color
 }
 
+#Long-running callbacks (background=True) run in their own processes through a disk cache
+#queue so they never hold up a gunicorn worker. Results are kept per data version for a day.
+background_manager = DiskcacheManager(
+    diskcache.Cache(os.environ.get('SNOWAPP_CACHE_DIR','./cache')),
+    cache_by=[lambda: dataversion],
+    expire=86400,
+)
+
 snowapp = Dash(
     __name__,
+    background_callback_manager=background_manager,
     external_stylesheets = [dbc.themes.SANDSTONE],
     meta_tags=[{'name': 'viewport', 'content': 'width=device-width, initial-scale=1'}],
     title = 'ENSO Snow BC: exploring snow accumulation and El Nino/La Nina in British Columbia',
@@ -191,6 +179,8 @@ server = snowapp.server
 
 
 
+modal_header_image_path = snowapp.get_asset_url('20250322_135400_small.jpg')
+
 modal = dbc.Modal(
     [
         #dbc.ModalHeader(),
@@ -244,16 +234,45 @@ reclengthselect = html.Div(
 )
 
 
+analogselect = html.Div(
+    [
+        #Highlight the past years whose snow so far this season best matches the current year
+        dcc.Checklist(
+            options=[
+                {'label': 'Show analog years?', 'value': 'analogs'},
+                {'label': 'Weight analogs by ONI?', 'value': 'oniweight'},
+            ],
+            value=[],
+            id='analog-check',
+        ),
+    ],
+)
+
 anomselect = html.Div(
     [
         #Want to implement a check whether to show the maps with anomalies or not.
         dcc.Checklist(
             options=[
                 {'label': 'Plot station anomalies?', 'value': 'anomstat'},
+                {'label': 'Interpolated surface?', 'value': 'surface'},
             ],
             value=[],
             id='show-anoms-stat',
         ),
+        dcc.RadioItems(
+            options=[
+                {'label': 'Percent of normal', 'value': 'pct'},
+                {'label': 'Percentile rank', 'value': 'rank'},
+                {'label': 'Percentile rank, ENSO years', 'value': 'rankenso'},
+                {'label': 'ENSO median, on date', 'value': 'ensoday'},
+                {'label': 'ENSO median, at peak', 'value': 'ensopeak'},
+                {'label': 'Peak SWE trend', 'value': 'trendpeak'},
+                {'label': 'Peak date trend', 'value': 'trendpeakday'},
+                {'label': 'Melt-out trend', 'value': 'trendmelt'},
+            ],
+            value='pct',
+            id='map-colour-mode',
+        ),
     ],
 )
 
@@ -280,12 +299,32 @@ slider = html.Div(
     ],
 )
 
+stationsearch = html.Div(
+    [
+        dbc.InputGroup([
+            dbc.Input(
+                id='station-search',
+                placeholder='Station ID, name or "lat, lon"',
+                debounce=True,
+                type='text',
+            ),
+        ], size='sm', className='mb-2'),
+        #The station shown on the chart, as its LCTN_ID
+        dcc.Store(id='selected-station', data=defaultstation),
+        #What the chart currently shows, so slider moves that select the same years do no work
+        dcc.Store(id='line-chart-state', data=None),
+        #Random per-tab ID for coalescing the requests sent while a slider is dragged
+        dcc.Store(id='session-id', data=None),
+        #Width of the browser window in pixels, which sets the chart's level of detail
+        dcc.Store(id='viewport-width', data=None),
+        dcc.Location(id='page-url', refresh=False),
+    ],
+)
+
 snowmap = html.Div(
     [
         dcc.Graph(
             id="snow-station-map",
-            #This is the initil point to draw data for. Clunky way of assigning it...
-            clickData={'points': [{'text': '3A25P Squamish River Upper<br>Elevation: 1360.0'}]},
             #Get rid of the selection buttons in the map because they will confuse with
             #The select on click action that's desired.
             config={
@@ -296,6 +335,47 @@ snowmap = html.Div(
     ],
 )
 
+#Month starts for the scrubber marks, labelled like the line chart's x axis
+anomdaymarks = {
+    anomarray['days'].index(day): {'label': label}
+    for day, label in zip(['10-01', '12-01', '02-01', '04-01', '06-01', '08-01'],
+                          ['1 Oct', '1 Dec', '1 Feb', '1 Apr', '1 Jun', '1 Aug'])
+}
+
+anomdatescrubber = html.Div(
+    [
+        html.P("Anomaly date (day of water year and water year):"),
+        dbc.Row([
+            dbc.Col([
+                dcc.Slider(
+                    min=0,
+                    max=len(anomarray['days'])-1,
+                    step=1,
+                    marks=anomdaymarks,
+                    value=latestanomday,
+                    updatemode='drag',
+                    id='anom-day-slider',
+                ),
+            ], width=7),
+            dbc.Col([
+                dcc.Dropdown(
+                    options=[int(year) for year in anomarray['years'][::-1]],
+                    value=latestanomyear,
+                    clearable=False,
+                    id='anom-wateryear',
+                ),
+            ], width=3),
+            dbc.Col([
+                dbc.Button("Play", id='anom-play', size='sm', n_clicks=0),
+            ], width=2),
+        ]),
+        #Steps the day slider while playing. Runs in the browser so each frame only costs the
+        #server the slice in scrub_station_map.
+        dcc.Interval(id='anom-play-interval', interval=250, disabled=True),
+    ],
+    className='mt-2',
+)
+
 snowgraph = html.Div(
     [
         dcc.Graph(
@@ -309,6 +389,29 @@ snowgraph = html.Div(
     ],
 )
 
+networksummary = html.Div(
+    [
+        html.P("Median peak and melt-out for the ENSO years picked on the slider against the full record, for every station passing the map's record filters."),
+        dbc.Row([
+            dbc.Col([
+                dbc.Button("Summarize stations", id='summary-run', n_clicks=0, className='me-2'),
+                dbc.Button("Cancel", id='summary-cancel', color='secondary', disabled=True),
+            ], width=12, lg=4),
+            dbc.Col([
+                dbc.Progress(id='summary-progress', value=0, striped=True, animated=True, style={'height': '24px'}),
+            ], width=12, lg=8),
+        ], className='mb-3'),
+        dash_table.DataTable(
+            id='summary-table',
+            columns=[{'name': heading, 'id': column} for column, heading in SUMMARY_COLUMNS],
+            data=[],
+            sort_action='native',
+            page_size=25,
+            style_table={'overflowX': 'auto'},
+        ),
+    ],
+)
+
 snowapp.layout = dbc.Container(
     children=[
     modal,
@@ -323,7 +426,9 @@ snowapp.layout = dbc.Container(
                                       'color': 'white', 
                                       'font-weight': 'bold'}),
                             dbc.CardBody([
+                                stationsearch,
                                 snowmap,
+                                anomdatescrubber,
                             ]),
                         ],
                         className="shadow",
@@ -363,7 +468,8 @@ snowapp.layout = dbc.Container(
                                 dbc.Row([
                                     dbc.Col([reclengthselect,], width=2),
                                     dbc.Col([anomselect,], width=2),
-                                    dbc.Col([slider,], width=8),
+                                    dbc.Col([analogselect,], width=2),
+                                    dbc.Col([slider,], width=6),
                                 ])
                             ]),
                         ])
@@ -376,6 +482,17 @@ snowapp.layout = dbc.Container(
                 label='Analysis',
                 children=[
                     analysis_desc_md(dcc),
+                    dbc.Card([
+                        dbc.CardHeader("ENSO Summary by Station",
+                           style={'background-color': COLORS['secondary'],
+                                  'color': 'white',
+                                  'font-weight': 'bold'}),
+                        dbc.CardBody([
+                            networksummary,
+                        ]),
+                    ],
+                    className="shadow mb-4",
+                    ),
                 ]
             ),
             dbc.Tab(
@@ -402,60 +519,337 @@ def toggle_modal(n_clicks, is_open):
 
 
 
+def filter_stations(reccheck):
+    '''
+    Work with the record length checklist to filter the location data according to
+    what is available in the master dataframe. The argument reccheck is the list
+    of strings created as output by the checklist that indicates the logical
+    filters. If present, then true, if absent, no filter.
+    '''
+    locdfuse = locdf
+    if ('rcy' in reccheck):
+        #Only keep stations with current year's data
+        locdfuse = locdfuse.loc[locdfuse['DATA_COLUMN'].isin(pd.Series(stations_with_current_year)),:]
+    if ('rtmy' in reccheck):
+        #Only keep stations that have 30 or more years of complete records.
+        locdfuse = locdfuse.loc[locdfuse['DATA_COLUMN'].isin(pd.Series(nyears_complete.index[nyears_complete >= 20])),:]
+    return locdfuse
+
+def oni_years(onirange):
+    #Water years with ONI strictly inside the slider range
+    return years_from_bitmask(telebitsets,select_years_bitmask(telebitsets,{'ONI': onirange}))
+
+@lru_cache(maxsize=1024)
+def composite_for_years(yearmask,dayidx):
+    #ENSO composites for a year set, keyed on its bitmask so slider moves that select the same years are free
+    return enso_composite(compositetable,years_from_bitmask(telebitsets,yearmask),dayidx)
+
+@lru_cache(maxsize=256)
+def station_pivot(stnname):
+    #A station's years side by side; df doesn't change while the app runs, so each is pivoted once
+    return pivot_station_years(df,stnname)
+
+@lru_cache(maxsize=256)
+def station_lod_rows(stnname,npoints):
+    #Days kept of each past year and full-record quantile of a station at a level of detail
+    subdf = station_pivot(stnname)
+    return lod_rows(pd.concat([subdf,full_quantiles(subdf)],axis=1,copy=False,),npoints)
+
+def line_chart_quantiles(stnname,subdf,onirange):
+    #Full-record and selected quantiles from the precomputed bands, or None, None to compute them
+    bands = lookup_quantile_bands(quantilebands,stnname,onirange)
+    if bands is None:
+        return None, None
+    return pd.DataFrame(bands[0],index=subdf.index,columns=TARGET_QUANTILES), pd.DataFrame(bands[1],index=subdf.index,columns=TARGET_QUANTILES)
+
+def oni_yearmask(onirange):
+    #Bitmask of the water years with ONI strictly inside the slider range
+    return select_years_bitmask(telebitsets,{'ONI': onirange})
+
+def station_colour_data(locdfuse,anomyear,anomday,yearmask):
+    '''
+    Add the percent of normal, percentile ranks and exceedance probabilities for the scrubber
+    date to locdfuse. Ranks are against all complete years and against the ENSO years selected
+    on the slider, given as their bitmask. The ENSO composites compare the selected years'
+    median with the full record's on the scrubber's day of the water year and at peak.
+    '''
+    stnnames = locdfuse['DATA_COLUMN']
+    rows = [ranktable['stations'][stnname] for stnname in stnnames]
+    daterow = date_row(anomarray,anomyear,anomday)
+    if daterow is None:
+        swe = np.full(len(stationcolumns),np.nan)
+    else:
+        swe = swevalues[daterow]
+    rank_full, exceed_full = rank_swe(ranktable,swe,anomday)
+    rank_enso, exceed_enso = rank_swe(ranktable,swe,anomday,years_from_bitmask(telebitsets,yearmask))
+    enso_day, enso_peak = composite_for_years(yearmask,anomday)
+    return locdfuse.assign(
+        pct_snow=anomaly_on_date(anomarray,anomyear,anomday,stnnames),
+        rank_full=rank_full[rows],
+        exceed_full=exceed_full[rows],
+        rank_enso=rank_enso[rows],
+        exceed_enso=exceed_enso[rows],
+        enso_day=enso_day[rows],
+        enso_peak=enso_peak[rows],
+    )
+
+@lru_cache(maxsize=64)
+def anomaly_surface(colourmode,anomyear,anomday,yearmask):
+    '''
+    Coloured anomaly surface for a colouring mode, scrubber date and ENSO year set, from all
+    stations. Modes that don't use the ENSO years are called with yearmask 0.
+    '''
+    colouring = MAP_COLOUR_MODES[colourmode]
+    locdfall = station_colour_data(locdf,anomyear,anomday,yearmask)
+    surface = idw_surface(
+        locdfall['LATITUDE'].to_numpy(dtype=float),
+        locdfall['LONGITUDE'].to_numpy(dtype=float),
+        locdfall[colouring['column']].to_numpy(dtype=float),
+        locdfall['ELEVATION'].to_numpy(dtype=float),
+    )
+    return surface_rgba(surface,colouring['cmin'],colouring['cmax'])
+
+@lru_cache(maxsize=4096)
+def anomaly_surface_tile(colourmode,anomyear,anomday,yearmask,z,x,y):
+    return render_tile(anomaly_surface(colourmode,anomyear,anomday,yearmask),z,x,y)
+
+#Surface tiles are named by everything they depend on, so the browser can keep them
+surfaceversion = df.index.max().strftime('%Y%m%d')
+
+@server.route('/surface/<version>/<colourmode>/<int:anomyear>/<int:anomday>/<yearmask>/<int:z>/<int:x>/<int:y>.png')
+def surface_tile(version,colourmode,anomyear,anomday,yearmask,z,x,y):
+    if (colourmode not in MAP_COLOUR_MODES) or (z > 18) or (x >= 2**z) or (y >= 2**z) or (anomday >= len(anomarray['days'])):
+        flask.abort(404)
+    try:
+        yearmask = int(yearmask,16)
+    except ValueError:
+        flask.abort(404)
+    #Only the URLs surface_layers hands out, so made-up ones cannot fill the tile caches
+    if (version != surfaceversion) or (anomyear not in anomarray['years']) or (yearmask >= 1 << len(telebitsets['years'])):
+        flask.abort(404)
+    if (yearmask != 0) and not MAP_COLOUR_MODES[colourmode]['enso']:
+        flask.abort(404)
+    response = flask.Response(anomaly_surface_tile(colourmode,anomyear,anomday,yearmask,z,x,y),mimetype='image/png')
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+def surface_layers(showsurface,colourmode,anomyear,anomday,yearmask):
+    #The map layer list: the surface tiles for the current selection under the markers, or nothing
+    if not showsurface:
+        return []
+    if not MAP_COLOUR_MODES[colourmode]['enso']:
+        yearmask = 0
+    path = snowapp.get_relative_path('/surface/{}/{}/{}/{}/{:x}/'.format(surfaceversion,colourmode,anomyear,anomday,yearmask))
+    return [dict(sourcetype='raster', source=[path+'{z}/{x}/{y}.png'], below='traces')]
+
 @snowapp.callback(
     Output('snow-station-map', 'figure'),
     Input('record-length-current-check','value'),
     Input('show-anoms-stat','value'),
+    State('anom-wateryear','value'),
+    State('anom-day-slider','value'),
+    State('map-colour-mode','value'),
+    State('oni-range-slider','value'),
 )
-def make_station_map(reccheck,anomstat):
+def make_station_map(reccheck,anomstat,anomyear,anomday,colourmode,onirange):
     '''
-    Work with the record length checklist to filter the location data according to
-    what is available in the master dataframe. The argument reccheck is the list
-    of strings created as output by the checklist that indicates the logical
-    filters. If present, then true, if absent, no filter.
+    Draw the station map for the stations passing the record length checklist. The
+    anomalies are shown for the date currently selected on the scrubber. Toggling the
+    anomalies leaves the stations as they are, so only the marker, hover data and surface
+    layer are sent. The surface is only drawn along with the station anomalies.
     '''
-    if len(anomstat) == 0:
+    showsurface = ('anomstat' in anomstat) and ('surface' in anomstat)
+    if 'anomstat' not in anomstat:
         #Plot single color symbols on the station map
         anomstat=False
     else:
         #Plot colors according to the current daily station anomaly
         anomstat=True
-    locdfuse = locdf
-    if ('rcy' in reccheck):
-        #Only keep stations with current year's data
-        locdfuse = locdfuse.loc[(locdfuse['LCTN_ID'] + ' ' + locdfuse['LCTN_NM']).isin(pd.Series(stations_with_current_year)),:]
-    if ('rtmy' in reccheck):
-        #Only keep stations that have 30 or more years of complete records.
-        locdfuse = locdfuse.loc[(locdfuse['LCTN_ID'] + ' ' + locdfuse['LCTN_NM']).isin(pd.Series(nyears_complete.index[nyears_complete >= 20])),:]
+    yearmask = oni_yearmask(onirange)
+    locdfuse = station_colour_data(filter_stations(reccheck),anomyear,anomday,yearmask)
+    layers = surface_layers(showsurface,colourmode,anomyear,anomday,yearmask)
+
+    if ctx.triggered_id == 'show-anoms-stat':
+        patched_map = Patch()
+        patched_map['data'][0]['marker'] = station_marker(locdfuse,anomstat,colourmode)
+        patched_map['data'][0]['customdata'] = locdfuse[MAP_CUSTOMDATA].to_numpy()
+        patched_map['layout']['map']['layers'] = layers
+        return patched_map
+    return draw_station_map(go,locdfuse,anomstat,colourmode,layers)
 
-    return draw_station_map(go,locdfuse,anomstat)
+@snowapp.callback(
+    Output('snow-station-map', 'figure', allow_duplicate=True),
+    Input('anom-wateryear','value'),
+    Input('anom-day-slider','value'),
+    Input('map-colour-mode','value'),
+    Input('oni-range-slider','value'),
+    State('record-length-current-check','value'),
+    State('show-anoms-stat','value'),
+    prevent_initial_call=True,
+)
+def scrub_station_map(anomyear,anomday,colourmode,onirange,reccheck,anomstat):
+    '''
+    Recolour the station markers for the date picked on the scrubber, the colouring mode
+    or the ENSO years. Only the marker colours, the hover data and the surface tile
+    address are sent; the rest of the map is left alone.
+    '''
+    if 'anomstat' not in anomstat:
+        raise PreventUpdate
+    yearmask = oni_yearmask(onirange)
+    locdfuse = station_colour_data(filter_stations(reccheck),anomyear,anomday,yearmask)
+    colouring = MAP_COLOUR_MODES[colourmode]
+    patched_map = Patch()
+    patched_map['data'][0]['marker']['color'] = locdfuse[colouring['column']].to_numpy()
+    patched_map['data'][0]['marker']['cmin'] = colouring['cmin']
+    patched_map['data'][0]['marker']['cmax'] = colouring['cmax']
+    patched_map['data'][0]['marker']['cmid'] = colouring['cmid']
+    patched_map['data'][0]['marker']['colorbar']['title']['text'] = colouring['title']
+    patched_map['data'][0]['customdata'] = locdfuse[MAP_CUSTOMDATA].to_numpy()
+    patched_map['layout']['map']['layers'] = surface_layers('surface' in anomstat,colourmode,anomyear,anomday,yearmask)
+    return patched_map
+
+#Play and pause the scrubber animation, then step the day slider on each tick. Both happen in the browser.
+snowapp.clientside_callback(
+    '''
+    function(n_clicks) {
+        var playing = (n_clicks % 2) === 1;
+        return [!playing, playing ? "Pause" : "Play"];
+    }
+    ''',
+    Output('anom-play-interval', 'disabled'),
+    Output('anom-play', 'children'),
+    Input('anom-play', 'n_clicks'),
+    prevent_initial_call=True,
+)
+
+snowapp.clientside_callback(
+    '''
+    function(n_intervals, day, maxday) {
+        return (day + 1) > maxday ? 0 : day + 1;
+    }
+    ''',
+    Output('anom-day-slider', 'value'),
+    Input('anom-play-interval', 'n_intervals'),
+    State('anom-day-slider', 'value'),
+    State('anom-day-slider', 'max'),
+    prevent_initial_call=True,
+)
+
+snowapp.clientside_callback(
+    '''
+    function(pathname) {
+        return Math.random().toString(36).slice(2) + Date.now().toString(36);
+    }
+    ''',
+    Output('session-id', 'data'),
+    Input('page-url', 'pathname'),
+)
+
+#The window width on load and, through a debounced resize listener, whenever it changes, such
+#as when a phone is rotated
+snowapp.clientside_callback(
+    '''
+    function(pathname) {
+        if (!window.snowappViewportListener) {
+            var timer = null;
+            var lastwidth = window.innerWidth;
+            window.snowappViewportListener = function() {
+                clearTimeout(timer);
+                timer = setTimeout(function() {
+                    if (window.innerWidth !== lastwidth) {
+                        lastwidth = window.innerWidth;
+                        dash_clientside.set_props('viewport-width', {data: lastwidth});
+                    }
+                }, 250);
+            };
+            window.addEventListener('resize', window.snowappViewportListener);
+        }
+        return window.innerWidth;
+    }
+    ''',
+    Output('viewport-width', 'data'),
+    Input('page-url', 'pathname'),
+)
+
+def resolve_url_station(search):
+    '''
+    Station from URL parameters, either ?station=<LCTN_ID> or ?lat=<lat>&lon=<lon> for the
+    nearest station. None if the parameters don't give one.
+    '''
+    params = parse_qs((search or '').lstrip('?'))
+    if 'station' in params:
+        return lookup_station(stationindex,params['station'][0].upper())
+    try:
+        lat, lon = float(params['lat'][0]), float(params['lon'][0])
+    except (KeyError, ValueError):
+        return None
+    if not ((-90 <= lat <= 90) and np.isfinite(lon)):
+        return None
+    positions = nearest_stations(stationindex,lat,lon)[0]
+    return positions[0] if len(positions) > 0 else None
+
+@snowapp.callback(
+    Output('selected-station', 'data'),
+    Input('snow-station-map', 'clickData'),
+    Input('station-search', 'value'),
+    Input('page-url', 'search'),
+)
+def select_station(clickData,searchtext,urlsearch):
+    '''
+    Resolve whichever of a map click, the search box or the URL changed to a station ID
+    through the station index.
+    '''
+    position = None
+    if (ctx.triggered_id == 'snow-station-map') and clickData:
+        #customdata[1] is the LCTN_ID of the clicked marker
+        position = lookup_station(stationindex,clickData['points'][0]['customdata'][1])
+    elif (ctx.triggered_id == 'station-search') and searchtext:
+        positions = search_stations(stationindex,searchtext,count=1)
+        position = positions[0] if len(positions) > 0 else None
+    elif ctx.triggered_id == 'page-url':
+        position = resolve_url_station(urlsearch)
+    if position is None:
+        return no_update
+    return stationindex['ids'][position]
 
 #Now make a callback that uses the values from the drop down and the slider selection to stratify the
 #data and make the plot
 
 @snowapp.callback(
     Output('snow-station-graph', 'figure'),
+    Output('line-chart-state', 'data'),
     Input('oni-range-slider', 'value'),
-    Input('snow-station-map', 'clickData'),
+    Input('selected-station', 'data'),
+    Input('analog-check', 'value'),
+    Input('viewport-width', 'data'),
+    State('line-chart-state', 'data'),
+    State('session-id', 'data'),
 )
-def update_line_chart(onirange,clickData):
+def update_line_chart(onirange,stationid,analogcheck,viewportwidth,chartstate,sessionid):
     '''
     Function to take the output from the slider and the station map callbacks
     and filter the master dataframe and the years according to the ONI magnitude
-    Then calls a subfunction to create the actual map.
+    Then calls a subfunction to create the actual map. A slider move keeps the station
+    and analogs, so it only patches the ENSO selection into the figure already drawn,
+    and only the title and colours when the selected years are the ones already shown.
+    A request superseded by a newer one from the same session stops at the checkpoints
+    before the pivot, after the quantiles and before the figure is sent. A new chart
+    is thinned to the level of detail for the viewport width, and redrawn when a resize
+    changes it; a patch keeps the figure's.
     '''
-    stnname = clickData['points'][0]['text'].split('<br>')[0]
-    subdf = pd.pivot_table(
-                df[[stnname,'hydrological_year','month-day']],
-                index=['month-day'],
-                columns="hydrological_year",
-                values=stnname
-            )
-    #The pivot re-orders the intex. 
-    #need to stack the bottom onto the top to make a hydrological year
-    subdf = pd.concat([subdf.iloc[-92:,:],subdf.iloc[0:(366-92):,]],axis=0)
-    yearsuse = mnxonidata.index[(mnxonidata["ANOM"] > onirange[0]) &
-        (mnxonidata["ANOM"] < onirange[1])].unique()
+    ticket = begin_request(sessionid,'snow-station-graph')
+    stnname = stationindex['columns'][lookup_station(stationindex,stationid)]
+    yearmask = oni_yearmask(onirange)
+    slidermove = ctx.triggered_id == 'oni-range-slider'
+    samestation = (chartstate is not None) and (chartstate['station'] == stationid)
+    if slidermove and samestation:
+        npoints = chartstate.get('npoints')
+    else:
+        npoints = lod_points(viewportwidth,MAXDAYIDX)
+    newstate = {'station': stationid, 'yearmask': str(yearmask), 'npoints': npoints}
+    #A resize that leaves the level of detail as it is needs no new chart
+    if (ctx.triggered_id == 'viewport-width') and (chartstate == newstate):
+        raise PreventUpdate
     if ((onirange[0] + onirange[1])/2 > 0):
         fillarea = fillninoarea
         fillline = fillninoline
@@ -464,7 +858,45 @@ def update_line_chart(onirange,clickData):
         fillline = fillninaline
 
     plottitle="Hydrologic Year SWE for {} Oceanic Niño Index Range {} to {}".format(stnname,onirange[0],onirange[1])
-    return snow_lineplot(
+    if slidermove and (chartstate == newstate):
+        return snow_lineplot_restyle(Patch,fillarea,fillline,plottitle), no_update
+
+    def checkpoint():
+        if superseded(sessionid,'snow-station-graph',ticket):
+            raise PreventUpdate
+
+    checkpoint()
+    subdf = station_pivot(stnname)
+    yearsuse = years_from_bitmask(telebitsets,yearmask)
+    quantiles, subquantiles = line_chart_quantiles(stnname,subdf,onirange)
+    #Without precomputed bands the selection's quantiles are the costly part, so they are done here
+    if subquantiles is None:
+        subquantiles = selected_quantiles(subdf,yearsuse)
+    checkpoint()
+
+    if slidermove and samestation:
+        patched = snow_lineplot_patch(
+            Patch,
+            pd,
+            subdf,
+            yearsuse,
+            currentyear,
+            fillarea,
+            fillline,
+            plottitle=plottitle,
+            subquantiles=subquantiles,
+            npoints=npoints,
+        )
+        checkpoint()
+        return patched, newstate
+
+    analogs = None
+    if ('analogs' in analogcheck) and (stnname in yearcube['stations']):
+        analogs = top_analogs(analogdistances['oniweight' in analogcheck],yearcube['years'],yearcube['stations'][stnname])
+
+    quantiles = full_quantiles(subdf,quantiles)
+    checkpoint()
+    fig = snow_lineplot(
         go,
         pd,
         subdf,
@@ -472,7 +904,93 @@ def update_line_chart(onirange,clickData):
         currentyear,
         fillarea,
         fillline,
-        plottitle=plottitle
+        plottitle=plottitle,
+        quantiles=quantiles,
+        subquantiles=subquantiles,
+        analogs=analogs,
+        analogday=latestanomday,
+        npoints=npoints,
+        lodrows=None if npoints is None else station_lod_rows(stnname,npoints),
+    )
+    #Serializing the whole figure is the last costly step
+    checkpoint()
+    return fig, newstate
+
+@snowapp.callback(
+    Output('snow-station-graph', 'figure', allow_duplicate=True),
+    Output('line-chart-state', 'data', allow_duplicate=True),
+    Input('snow-station-graph', 'relayoutData'),
+    State('oni-range-slider', 'value'),
+    State('viewport-width', 'data'),
+    State('line-chart-state', 'data'),
+    prevent_initial_call=True,
+)
+def zoom_line_chart(relayoutdata,onirange,viewportwidth,chartstate):
+    '''
+    Swap the thinned lines of a chart drawn at a reduced level of detail for every day when
+    the x axis is zoomed, and back when it is reset. Only the lines' x and y are sent.
+    '''
+    lodpoints = lod_points(viewportwidth,MAXDAYIDX)
+    if (lodpoints is None) or (chartstate is None) or (relayoutdata is None):
+        raise PreventUpdate
+    if ('xaxis.range[0]' in relayoutdata) or ('xaxis.range' in relayoutdata):
+        npoints = None
+    elif 'xaxis.autorange' in relayoutdata:
+        npoints = lodpoints
+    else:
+        raise PreventUpdate
+    yearmask = oni_yearmask(onirange)
+    #Leave a chart that is still catching up with the slider to update_line_chart
+    if (chartstate.get('npoints') == npoints) or (chartstate['yearmask'] != str(yearmask)):
+        raise PreventUpdate
+
+    stnname = stationindex['columns'][lookup_station(stationindex,chartstate['station'])]
+    subdf = station_pivot(stnname)
+    quantiles, subquantiles = line_chart_quantiles(stnname,subdf,onirange)
+    return snow_lineplot_resolution(
+        Patch,
+        pd,
+        subdf,
+        years_from_bitmask(telebitsets,yearmask),
+        currentyear,
+        quantiles=quantiles,
+        subquantiles=subquantiles,
+        npoints=npoints,
+        lodrows=None if npoints is None else station_lod_rows(stnname,npoints),
+    ), dict(chartstate,npoints=npoints)
+
+@snowapp.callback(
+    Output('summary-table', 'data'),
+    Input('summary-run', 'n_clicks'),
+    State('oni-range-slider', 'value'),
+    State('record-length-current-check', 'value'),
+    background=True,
+    running=[
+        (Output('summary-run', 'disabled'), True, False),
+        (Output('summary-cancel', 'disabled'), False, True),
+    ],
+    cancel=[Input('summary-cancel', 'n_clicks')],
+    progress=[Output('summary-progress', 'value'), Output('summary-progress', 'label')],
+    cache_args_to_ignore=[0],
+    prevent_initial_call=True,
+)
+def summarize_stations(set_progress,n_clicks,onirange,reccheck):
+    '''
+    Build the station summary table for the slider's ENSO years as a background job, reporting
+    progress after each station. Cancel stops the job; the interactive callbacks carry on
+    in the web workers meanwhile.
+    '''
+    def progress(done,total):
+        set_progress((100*done/total, '{} of {} stations'.format(done,total)))
+    return network_summary(
+        pd,
+        df,
+        filter_stations(reccheck),
+        oni_years(onirange),
+        pivot_station_years,
+        bandsfile=quantilebands,
+        onirange=onirange,
+        progress=progress,
     )
 
 if __name__ == '__main__':
@@ -0,0 +1,186 @@
+import numpy as np
+from os.path import isfile
+from functools import lru_cache
+from snowdata import data_version, pivot_station_years
+from snowplot import MAXDAYIDX, TARGET_QUANTILES, complete_year_mask
+
+'''
+Offline precomputation of the quantile bands drawn by snow_lineplot.
+
+The ONI slider selects the years whose ANOM falls strictly inside the slider range. Once a
+station's complete years are sorted by ANOM, any selection is a contiguous run of that sorted
+list, so there are at most n(n+1)/2 distinct year sets for n years no matter how many slider
+positions there are. The build step enumerates the runs that the slider grid can reach for
+every station and stores the seven quantile curves of each in a single .npz file. The app then
+answers a slider move with two binary searches and an array lookup.
+
+Quantiles are stored as int16 in half-millimetres (exact for the whole-millimetre pillow data,
+whose midpoint quantiles land on half millimetres) with BAND_MISSING for days without data.
+
+Build with:
+    python snowbands.py [./snow/quantile_bands.npz]
+or together with the other derived data by snowprecompute.py.
+'''
+
+QUANTILE_BANDS_FILE = './snow/quantile_bands.npz'
+BAND_SCALE = 2.
+BAND_MISSING = np.iinfo(np.int16).min
+#Stations whose arrays an open bands file keeps in memory
+BANDS_CACHE_STATIONS = 32
+
+def encode_bands(quantiles):
+    #quantiles is (ndays, nquantiles) of float SWE.
+    encoded = np.full(quantiles.shape,BAND_MISSING,dtype=np.int16)
+    havedata = ~np.isnan(quantiles)
+    encoded[havedata] = np.round(quantiles[havedata]*BAND_SCALE)
+    return encoded.T
+
+def decode_bands(encoded):
+    quantiles = encoded.T.astype(float)/BAND_SCALE
+    quantiles[encoded.T == BAND_MISSING] = np.nan
+    return quantiles
+
+def slider_grid(lower=-3,upper=3,step=0.1):
+    #The slider positions reachable with the ONI RangeSlider
+    return np.round(np.arange(lower,upper+step/2,step),10)
+
+def midpoint_quantiles(values,quantiles):
+    '''
+    Vectorized equivalent of DataFrame.quantile(quantiles,axis=1,interpolation='midpoint') on a
+    (ndays, nyears) array: missing values are skipped and the result is (ndays, nquantiles).
+    np.nanquantile falls back to a per-row Python loop when there are gaps, so sort once instead.
+    '''
+    ordered = np.sort(values,axis=1)
+    nvalid = (~np.isnan(values)).sum(axis=1)
+    position = np.outer(nvalid-1,quantiles)
+    lower = np.clip(np.floor(position),0,None).astype(int)
+    upper = np.clip(np.ceil(position),0,None).astype(int)
+    rows = np.arange(len(values))[:,None]
+    result = (ordered[rows,lower]+ordered[rows,upper])/2
+    result[nvalid == 0,:] = np.nan
+    return result
+
+def station_year_runs(sortedanom,grid):
+    '''
+    Find the distinct (start, stop) runs of the ANOM-sorted years that the slider grid can
+    select. Empty runs are left out since their quantiles are all missing.
+    '''
+    starts = np.searchsorted(sortedanom,grid,side='right')
+    stops = np.searchsorted(sortedanom,grid,side='left')
+    runs = set()
+    for k in range(len(grid)):
+        for stop in np.unique(stops[k+1:]):
+            if stop > starts[k]:
+                runs.add((int(starts[k]),int(stop)))
+    return sorted(runs)
+
+def build_station_bands(df,stnname,teleseries,grid):
+    '''
+    Compute the full-record quantiles and the quantiles of every reachable ENSO subset for one
+    station. Returns a dict of the arrays stored in the bands file.
+    '''
+    subdf = pivot_station_years(df,stnname)
+    completedf = subdf.loc[:,complete_year_mask(subdf,MAXDAYIDX)]
+    full = completedf.quantile(TARGET_QUANTILES,axis=1,interpolation='midpoint').transpose()
+
+    anom = teleseries.reindex(completedf.columns)
+    anom = anom[anom.notna()].sort_values(kind='stable')
+    sortedanom = anom.to_numpy(dtype=float)
+    values = completedf.loc[:,anom.index].to_numpy(dtype=float)
+
+    runs = station_year_runs(sortedanom,grid)
+    lookup = np.full((len(sortedanom)+1,len(sortedanom)+1),-1,dtype=np.int32)
+    bands = np.empty((len(runs),len(TARGET_QUANTILES),len(subdf.index)),dtype=np.int16)
+    for row, (start, stop) in enumerate(runs):
+        lookup[start,stop] = row
+        #Same midpoint quantiles that DataFrame.quantile gives in snow_lineplot
+        bands[row] = encode_bands(midpoint_quantiles(values[:,start:stop],TARGET_QUANTILES))
+
+    return {
+        'anom': sortedanom,
+        'lookup': lookup,
+        'bands': bands,
+        'full': encode_bands(full.to_numpy(dtype=float)),
+    }
+
+def build_quantile_bands(df,stations,teleseries,filename=QUANTILE_BANDS_FILE,grid=None):
+    '''
+    Build step: enumerate the distinct ENSO year subsets for every station in stations and
+    write their quantile curves to filename. teleseries is the per-water-year index used by the
+    slider (e.g. teletable['ONI']). The data_version of df is stored so that a stale file is
+    ignored once new data arrive or the stations change.
+    '''
+    if grid is None:
+        grid = slider_grid()
+    stationbands = {stnname: build_station_bands(df,stnname,teleseries,grid) for stnname in stations}
+    return write_quantile_bands(stationbands,stations,data_version(df),filename)
+
+def write_quantile_bands(stationbands,stations,dataversion,filename=QUANTILE_BANDS_FILE):
+    #Pack the per-station arrays from build_station_bands into one compressed npz
+    arrays = {
+        'stations': np.array(stations),
+        'dataversion': np.array(dataversion),
+    }
+    for k, stnname in enumerate(stations):
+        for key, value in stationbands[stnname].items():
+            arrays['{}_{}'.format(k,key)] = value
+    np.savez_compressed(filename,**arrays)
+    return filename
+
+@lru_cache(maxsize=None)
+def load_quantile_bands(filename=QUANTILE_BANDS_FILE,dataversion=None):
+    '''
+    Open a bands file. Returns None if there is no file or it was built from different data.
+    The station arrays themselves are read lazily by station_bands.
+    '''
+    if not isfile(filename):
+        return None
+    bandsfile = np.load(filename)
+    if (dataversion is not None) and (('dataversion' not in bandsfile) or (str(bandsfile['dataversion']) != str(dataversion))):
+        return None
+    stations = {stnname: k for k, stnname in enumerate(bandsfile['stations'])}
+
+    #Each station's arrays are read once and kept for the most recently used stations only
+    @lru_cache(maxsize=BANDS_CACHE_STATIONS)
+    def read_station(stnname):
+        k = stations[stnname]
+        return {name: bandsfile['{}_{}'.format(k,name)] for name in ['anom','lookup','bands','full']}
+
+    return {
+        'file': bandsfile,
+        'stations': stations,
+        'read_station': read_station,
+    }
+
+def station_bands(bandsfile,stnname):
+    #One station's arrays from the open npz file
+    return bandsfile['read_station'](stnname)
+
+def lookup_quantile_bands(bandsfile,stnname,onirange):
+    '''
+    Answer a slider position from the precomputed bands. Returns (full, subset) arrays of shape
+    (ndays, nquantiles), or None when the station or the year set is not in the file so the
+    caller can fall back to computing the quantiles.
+    '''
+    if (bandsfile is None) or (stnname not in bandsfile['stations']):
+        return None
+    arrays = station_bands(bandsfile,stnname)
+    start = np.searchsorted(arrays['anom'],onirange[0],side='right')
+    stop = np.searchsorted(arrays['anom'],onirange[1],side='left')
+    full = decode_bands(arrays['full'])
+    if stop <= start:
+        return full, np.full(full.shape,np.nan)
+    row = arrays['lookup'][start,stop]
+    if row < 0:
+        return None
+    return full, decode_bands(arrays['bands'][row])
+
+if __name__ == '__main__':
+    import sys
+    from snowdata import prepare_snow_data, get_teleconnection_table
+    df, locdf, stations_with_current_year = prepare_snow_data()
+    teletable = get_teleconnection_table(['ONI'])
+    filename = sys.argv[1] if len(sys.argv) > 1 else QUANTILE_BANDS_FILE
+    stations = locdf['DATA_COLUMN'].to_list()
+    build_quantile_bands(df,stations,teletable['ONI'],filename)
+    print('Wrote quantile bands for {} stations to {}'.format(len(stations),filename))
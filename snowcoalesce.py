@@ -0,0 +1,40 @@
+import threading
+from collections import OrderedDict
+
+'''
+Per-session coalescing of the requests sent while a slider is dragged.
+
+With updatemode='drag' the browser sends a request for every step and only shows the answer to
+the last one. Each request takes a ticket for its session and output when it starts; a request
+that finds a newer ticket at one of its checkpoints has been superseded and can stop before
+doing any more work. Only requests handled by the same process see each other's tickets, so
+under several gunicorn workers this bounds the work per worker.
+
+Requests can only overlap within a process that runs several at once, so this needs gunicorn
+with --threads above 1, as in the Procfile. A sync worker with one thread serves a session's
+requests one after another and none of them is ever superseded.
+'''
+
+#Sessions remembered per process; the oldest are forgotten first
+MAX_SESSIONS = 10000
+
+_lock = threading.Lock()
+_tickets = OrderedDict()
+
+def begin_request(sessionid,output):
+    #Take the next ticket for the session's requests to output. None if there is no session.
+    if sessionid is None:
+        return None
+    key = (sessionid,output)
+    with _lock:
+        ticket = _tickets.pop(key,0) + 1
+        _tickets[key] = ticket
+        while len(_tickets) > MAX_SESSIONS:
+            _tickets.popitem(last=False)
+    return ticket
+
+def superseded(sessionid,output,ticket):
+    #True once a newer request from the same session has started on output
+    if ticket is None:
+        return False
+    return _tickets.get((sessionid,output),ticket) != ticket
@@ -0,0 +1,62 @@
+import warnings
+import numpy as np
+from snowplot import MAXDAYIDX
+
+'''
+ENSO-composite anomalies for the map: each station's median SWE over the years selected on the
+ONI slider as a percentage of its full-record median, either on a given day of the water year or
+for the annual peak.
+
+The full-record medians are taken once from the (station x year x day) cube of build_year_cube,
+so a new year set costs a median over the selected years' slice of the cube for all stations at
+once. Only complete years other than the current one count, as for the chart's quantiles.
+'''
+
+#Fewer complete years than this in the selection leaves a station without a composite
+COMPOSITE_MIN_YEARS = 5
+
+def nanmedian(values,axis):
+    #np.nanmedian without the warning for stations with no data
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore',category=RuntimeWarning)
+        return np.nanmedian(values,axis=axis)
+
+def build_composite_table(yearcube,currentyear):
+    '''
+    Annual peaks and full-record medians by day and at peak for the stations of the year cube.
+    values is the cube itself, not a copy.
+    '''
+    complete = yearcube['complete'] & (yearcube['years'] != currentyear)[None,:]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore',category=RuntimeWarning)
+        peak = np.nanmax(yearcube['values'][:,:,0:MAXDAYIDX],axis=2)
+    peak[~complete] = np.nan
+
+    return {
+        'values': yearcube['values'],
+        'complete': complete,
+        'peak': peak,
+        'fullday': nanmedian(np.where(complete[:,:,None],yearcube['values'],np.nan),axis=1),
+        'fullpeak': nanmedian(peak,axis=1),
+        'years': yearcube['years'],
+        'stations': yearcube['stations'],
+    }
+
+def enso_composite(compositetable,yearsuse,dayidx):
+    '''
+    Percent of the full-record median for the yearsuse median on day of water year dayidx and
+    at peak, for every station of the table. NaN where either median is missing or zero or
+    there are fewer than COMPOSITE_MIN_YEARS complete years in yearsuse.
+    '''
+    selected = np.isin(compositetable['years'],yearsuse)
+    complete = compositetable['complete'][:,selected]
+    daymedian = nanmedian(np.where(complete,compositetable['values'][:,selected,dayidx],np.nan),axis=1)
+    peakmedian = nanmedian(compositetable['peak'][:,selected],axis=1)
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        pctday = 100*daymedian/compositetable['fullday'][:,dayidx]
+        pctpeak = 100*peakmedian/compositetable['fullpeak']
+    tooshort = complete.sum(axis=1) < COMPOSITE_MIN_YEARS
+    pctday[~np.isfinite(pctday) | tooshort] = np.nan
+    pctpeak[~np.isfinite(pctpeak) | tooshort] = np.nan
+    return pctday, pctpeak
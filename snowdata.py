@@ -1,5 +1,11 @@
-from os.path import isfile
-from pandas import read_csv, read_fwf, concat, Timedelta
+import os
+import re
+import hashlib
+from os.path import isfile, join
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from pandas import read_csv, read_fwf, concat, pivot_table, DataFrame, Index, Timedelta
+from datetime import datetime
 import numpy as np
 
 def get_snow_archive(localfilename=None):
@@ -27,9 +33,20 @@ def get_fresh_snow(localfilename=None):
 
     return dffresh
 
-def load_munge_snow_data():
-    dfarch = get_snow_archive()
-    dffresh = get_fresh_snow()
+#Directory to read the snow and ONI files from instead of the web, e.g. ./snow for offline runs.
+#Without an SW_DailyArchive.csv there only the current year's SWDaily.csv is used.
+LOCAL_DATA_DIR = os.environ.get('SNOWAPP_DATA_DIR')
+
+def load_munge_snow_data(datadir=LOCAL_DATA_DIR):
+    if datadir is None:
+        dfarch = get_snow_archive()
+        dffresh = get_fresh_snow()
+    else:
+        dffresh = get_fresh_snow(join(datadir,'SWDaily.csv'))
+        if isfile(join(datadir,'SW_DailyArchive.csv')):
+            dfarch = get_snow_archive(join(datadir,'SW_DailyArchive.csv'))
+        else:
+            dfarch = dffresh.iloc[0:0,:]
     df = concat([dfarch,dffresh],axis=0)
 
     #Check current year's data for entries with all na/no data
@@ -72,14 +89,259 @@ def load_munge_snow_data():
 
     return df, stations_with_current_year
 
-#Import oceanic Nino index and massage into a form that allows selection by ENSO strength
-def get_wyear_extrema_oni():
-    onidata = read_fwf('https://www.cpc.ncep.noaa.gov/data/indices/oni.ascii.txt')
-    #onidata = read_fwf('./snow/oni.ascii.txt')
-    oniseaslist = list(['OND','NDJ','DJF','JFM','FMA','MAM'])
-    onidata = onidata[onidata['SEAS'].isin(oniseaslist)]
-    #Need to add a year to the OND and NDJ seasoned years to correspond to the hydrological year that ENSO cycle belongs to.
-    onidata['YR'] = onidata['YR'].mask(onidata['SEAS'].isin(['OND','NDJ']),onidata['YR']+1)
+# Make a column formatted that gives the hydrological year. Essentially the time index, forward by 3 months,
+# then reformatted to %Y using strftime.
+def datetimepandas(timestamp,theformat):
+    return datetime.strftime(timestamp,theformat)
+def hydrodoy_from_timestamp(timestamps):
+    """
+    This function takes a pandas data Series object of timestamps and converts it into the day of the hydrological
+    year which starts on 1 October and runs through the end of September. Returns a pandas Series of those days of year.
+
+    Leap years are accommodated in an ugly way through making masks on the vector. I'm sure there are more elegant ways
+    of doing this!
+    """
+    #Calculating the julian day is the first, necessary step.
+    hydrodoy = timestamps.apply(datetimepandas,args=('%j',)).astype(int)
+    #Next, need to link logic to operate one way for years where YEAR % 4 == 0 and anotherway for years where YEAR % 4 ~= 0
+    leapmask = timestamps.apply(datetime.strftime,args=('%Y',)).astype(int) % 4 == 0
+    hydrodoy = hydrodoy - 273
+    hydrodoy.loc[leapmask] = hydrodoy.loc[leapmask] - 1 #Adjust for the leap year
+    negleapmask = leapmask & (hydrodoy < 1)
+    hydrodoy = hydrodoy.mask(hydrodoy < 1, hydrodoy+365) #Correct the days of the year prior to 1 October back to their order
+    hydrodoy.loc[negleapmask] = hydrodoy.loc[negleapmask] + 1 #Adjust for the leap year
+    return hydrodoy
+
+def wateryear_from_timestamps(timestamps):
+    """
+    This function takes a pandas data Series object of timestamps and determines the hydrological year the date
+    belongs to. Essentially, has to look at the year 92 days in the future.
+
+    Needs error trapping or at least some type checking.
+    """
+    wateryears = timestamps + Timedelta("92 day")
+    wateryears = wateryears.apply(datetimepandas,args=('%Y',))
+    wateryears = wateryears.astype(int)
+    return wateryears
+
+#Registry of the snow networks the app can load. Every adapter normalizes its network to the
+#same two tables: station metadata with the STATION_META_COLUMNS (elevations in metres) and
+#daily SWE in mm with a row per date and a column per LCTN_ID. It also returns the IDs of the
+#stations reporting in the current water year. Adapters take local file names so they can be
+#run against fixture files.
+STATION_META_COLUMNS = ['LCTN_ID','LCTN_NM','ELEVATION','STATUS','LATITUDE','LONGITUDE','NETWORK']
+SNOW_SOURCES = {}
+def snow_source_names(text):
+    #Network names from a comma separated list, ignoring spaces around the commas and empty entries
+    return [name.strip() for name in text.split(',') if name.strip()]
+
+#The networks prepare_snow_data loads, as a comma separated list of registered names
+SNOWAPP_SOURCES = snow_source_names(os.environ.get('SNOWAPP_SOURCES','BC ASWS'))
+
+INCH_MM = 25.4
+FOOT_M = 0.3048
+
+def register_snow_source(name,loader,**options):
+    #Add a network to the registry. loader(**options) returns (metadata, swe, current station IDs).
+    SNOW_SOURCES[name] = {'loader': loader, 'options': options}
+
+def load_bc_asws(datadir=LOCAL_DATA_DIR,metafilename='./snow/SNW_ASWS.csv'):
+    '''
+    BC automated snow weather stations from the ASWS archive and current year CSVs (or their
+    copies in datadir) and the SNW_ASWS station list.
+    '''
+    df, stations_with_current_year = load_munge_snow_data(datadir)
+    #The ASWS files name their columns "<LCTN_ID> <LCTN_NM>"
+    swe = df.set_axis([column.split(' ',1)[0] for column in df.columns],axis=1)
+    current = [column.split(' ',1)[0] for column in stations_with_current_year]
+    meta = read_csv(metafilename).assign(NETWORK='BC ASWS')
+    return meta.loc[:,STATION_META_COLUMNS], swe, current
+
+def load_snotel_csv(datafile='./snow/snotel_swe.csv',metafile='./snow/snotel_stations.csv',network='SNOTEL'):
+    '''
+    SNOTEL-style exports from the NRCS report generator. datafile has '#' comment lines, a Date
+    column and a "<Name> (<id>) Snow Water Equivalent (in) ..." column per station. metafile lists
+    the stations with Station Id, Station Name, Elevation (ft), Latitude and Longitude columns.
+    Station IDs become "<id>:SNTL" so they don't collide with other networks.
+    '''
+    raw = read_csv(datafile,comment='#',index_col=[0],parse_dates=[0])
+    ids = [re.search(r'\((\d+)\)',column).group(1)+':SNTL' for column in raw.columns]
+    swe = INCH_MM*raw.set_axis(ids,axis=1)
+
+    #Stations without an elevation can't be placed on the elevation-adjusted map layers, so they are left out
+    stations = read_csv(metafile).dropna(subset=['Elevation (ft)'])
+    meta = stations.assign(
+        LCTN_ID=stations['Station Id'].astype(str)+':SNTL',
+        LCTN_NM=stations['Station Name'],
+        ELEVATION=(FOOT_M*stations['Elevation (ft)']).round().astype(int),
+        STATUS='Active',
+        LATITUDE=stations['Latitude'],
+        LONGITUDE=stations['Longitude'],
+        NETWORK=network,
+    )
+    return meta.loc[:,STATION_META_COLUMNS], swe, stations_reporting(swe)
+
+def stations_reporting(swe):
+    #Stations with data since the start of the latest water year
+    wateryearstart = datetime((swe.index.max()+Timedelta('92 day')).year-1,10,1)
+    return swe.columns[swe.loc[swe.index >= wateryearstart,:].notna().any()].to_list()
+
+register_snow_source('BC ASWS',load_bc_asws)
+register_snow_source('SNOTEL',load_snotel_csv)
+
+def combine_snow_sources(results):
+    '''
+    Merge the (metadata, swe, current) results of several adapters into one metadata table,
+    sorted by LCTN_ID, and one daily SWE dataframe with a column per station in the same order.
+    Only stations with both metadata and data are kept; the first network to list an ID wins.
+    '''
+    metas, swes, current = [], [], []
+    for meta, swe, reporting in results:
+        #Daily rows on the date alone so networks observing at different hours line up
+        swe = swe.groupby(swe.index.normalize()).first()
+        meta = meta.loc[meta['LCTN_ID'].isin(swe.columns),:]
+        metas.append(meta)
+        swes.append(swe.loc[:,meta['LCTN_ID']])
+        current += list(reporting)
+    meta = concat(metas,axis=0).drop_duplicates('LCTN_ID').sort_values('LCTN_ID').reset_index(drop=True)
+    swe = concat(swes,axis=1).sort_index()
+    swe = swe.loc[:,~swe.columns.duplicated()].loc[:,meta['LCTN_ID']].dropna(axis=0,how='all')
+    return meta, swe, current
+
+def snow_source(name):
+    #The registry entry for a network, with the registered names in the error if there is none
+    if name not in SNOW_SOURCES:
+        raise KeyError('Unknown snow source {!r}; registered sources are {}'.format(name,', '.join(SNOW_SOURCES)))
+    return SNOW_SOURCES[name]
+
+def load_snow_sources(names=None):
+    #Run the adapters for the named networks (SNOWAPP_SOURCES by default) in parallel and combine them
+    names = SNOWAPP_SOURCES if names is None else names
+    sources = [snow_source(name) for name in names]
+    def run(source):
+        return source['loader'](**source['options'])
+    with ThreadPoolExecutor(max_workers=len(names)) as pool:
+        results = list(pool.map(run,sources))
+    return combine_snow_sources(results)
+
+def prepare_snow_data(sources=SNOWAPP_SOURCES):
+    '''
+    Load the snow networks named in sources through their adapters and add the hydrological day
+    of year, hydrological year and month-day columns. Returns the snow dataframe, with a
+    "<LCTN_ID> <LCTN_NM>" column per station, the location dataframe, whose DATA_COLUMN gives each
+    station's column, and the columns of the stations with current year data.
+    '''
+    locdf, swe, current = load_snow_sources(sources)
+    locdf['DATA_COLUMN'] = locdf['LCTN_ID'] + ' ' + locdf['LCTN_NM']
+    df = swe.set_axis(locdf['DATA_COLUMN'].to_list(),axis=1)
+    stations_with_current_year = locdf.loc[locdf['LCTN_ID'].isin(current),'DATA_COLUMN'].to_list()
+
+    locdf['text'] = locdf['DATA_COLUMN'] + '<br>Elevation: ' + (locdf['ELEVATION']).astype(str)
+
+    # ## Station Snow Statistics
+    #
+    # Interested in being able to correlate ENSO with timing of peak snow and amount of snow at the peak. Also interested in magnitude of peak melt rate and timing of the peak melt rate. These satistics will be part of a map-based view of the station data that will be colourized by the level of correlation or by the percent of peak snow associated with the
+    df['hydrodoy'] = hydrodoy_from_timestamp(df.index.to_series())
+    df['hydrological_year'] = wateryear_from_timestamps(df.index.to_series())
+
+    #Add on the month-day column for better plotting
+    df['month-day'] = df.index.strftime('%m-%d')
+    #Drop all leap years
+    df = df.loc[(~(df['month-day']=='02-29')),:]
+
+    return df, locdf, stations_with_current_year
+
+def data_version(df):
+    '''
+    Tag for the artifacts built from the snow dataframe: its last date and a hash of its columns
+    and dates, so an artifact built for another station set or record is not picked up.
+    '''
+    digest = hashlib.sha1('\n'.join(map(str,df.columns)).encode())
+    digest.update(df.index.to_numpy(dtype='datetime64[ns]').tobytes())
+    return '{}-{}'.format(df.index.max().strftime('%Y%m%d'),digest.hexdigest()[0:12])
+
+def pivot_station_years(df,stnname):
+    '''
+    Pivot a single station out of the master dataframe into a table with month-day rows and a
+    column per hydrological year.
+    '''
+    subdf = pivot_table(
+                df[[stnname,'hydrological_year','month-day']],
+                index=['month-day'],
+                columns="hydrological_year",
+                values=stnname
+            )
+    #The pivot re-orders the intex. 
+    #need to stack the bottom onto the top to make a hydrological year
+    subdf = concat([subdf.iloc[-92:,:],subdf.iloc[0:(366-92):,]],axis=0)
+    return subdf
+
+#Registry of the teleconnection indices that can be used to stratify the snow data. Each entry
+#knows where to find the index, how to parse it into a table of SEAS, YR and ANOM columns,
+#which seasons (or months) make up the winter window and which of those seasons fall in the
+#calendar year before the hydrological year they belong to.
+ONI_SEASONS = ['OND','NDJ','DJF','JFM','FMA','MAM']
+CPC_MONTHLY_SEASONS = [11,12,1,2,3,4]
+
+def parse_oni_table(source):
+    #ONI comes as fixed width columns of SEAS, YR, TOTAL and ANOM
+    return read_fwf(source)
+
+def parse_cpc_monthly_table(source):
+    #The CPC monthly teleconnection files are whitespace separated year, month, value with no header.
+    #Rename so that the months play the role of the ONI seasons.
+    return read_csv(source,sep=r'\s+',header=None,names=['YR','SEAS','ANOM'])
+
+TELECONNECTION_INDICES = {}
+
+def register_teleconnection(name,url,parser,seasons,prior_year_seasons):
+    '''
+    Add a teleconnection index to the registry. The parser takes a url or filename and returns a
+    dataframe with SEAS, YR and ANOM columns. seasons is the default winter window used to find the
+    water-year extrema and prior_year_seasons lists the seasons that belong to the following
+    hydrological year (e.g. OND and NDJ for the ONI). The last part of the url is the file name
+    looked for in LOCAL_DATA_DIR.
+    '''
+    TELECONNECTION_INDICES[name] = {
+        'url': url,
+        'filename': url.rsplit('/',1)[-1],
+        'parser': parser,
+        'seasons': list(seasons),
+        'prior_year_seasons': list(prior_year_seasons),
+    }
+
+register_teleconnection('ONI','https://www.cpc.ncep.noaa.gov/data/indices/oni.ascii.txt',
+    parse_oni_table,ONI_SEASONS,['SON','OND','NDJ'])
+register_teleconnection('PNA','https://www.cpc.ncep.noaa.gov/products/precip/CWlink/pna/norm.pna.monthly.b5001.current.ascii',
+    parse_cpc_monthly_table,CPC_MONTHLY_SEASONS,[10,11,12])
+register_teleconnection('NAO','https://www.cpc.ncep.noaa.gov/products/precip/CWlink/pna/norm.nao.monthly.b5001.current.ascii',
+    parse_cpc_monthly_table,CPC_MONTHLY_SEASONS,[10,11,12])
+
+@lru_cache(maxsize=None)
+def read_teleconnection(name,source=None):
+    '''
+    Parse the raw table for a registered index. Cached so that each index is only fetched once
+    per process no matter how many seasonal windows are asked of it. source overrides the
+    registry url, e.g. with a local file such as ./snow/oni.ascii.txt
+    '''
+    entry = TELECONNECTION_INDICES[name]
+    if (source is None) and (LOCAL_DATA_DIR is not None) and isfile(join(LOCAL_DATA_DIR,entry['filename'])):
+        source = join(LOCAL_DATA_DIR,entry['filename'])
+    elif source is None:
+        source = entry['url']
+    elif not source.startswith(('http','ftp')) and not isfile(source):
+        raise FileNotFoundError(f'File {source} could not be found')
+    return entry['parser'](source)
+
+#Import a teleconnection index and massage into a form that allows selection by its strength
+def get_wyear_extrema_index(name,seasons=None,source=None):
+    entry = TELECONNECTION_INDICES[name]
+    if seasons is None:
+        seasons = entry['seasons']
+    onidata = read_teleconnection(name,source)
+    onidata = onidata[onidata['SEAS'].isin(seasons)].copy()
+    #Need to add a year to the early seasons to correspond to the hydrological year that cycle belongs to.
+    onidata['YR'] = onidata['YR'].mask(onidata['SEAS'].isin(entry['prior_year_seasons']),onidata['YR']+1)
 
 
     #Issue here is that the selector finds the years where the ONI range was met, but needs
@@ -103,6 +365,66 @@ def get_wyear_extrema_oni():
     #Get most recent ONI and use this to set pick an ONI range to use in the slider initially.
     return mnxonidata
 
+def get_wyear_extrema_oni(seasons=None,source=None):
+    #onidata = read_fwf('./snow/oni.ascii.txt')
+    return get_wyear_extrema_index('ONI',seasons=seasons,source=source)
+
+def get_teleconnection_table(names,seasons=None,sources=None):
+    '''
+    Build the compact per-water-year value table: index of hydrological years, one column per
+    teleconnection index holding that index's water-year extreme. seasons and sources are
+    optional dicts keyed by index name to override the seasonal window or data location.
+    Years missing from an index are NaN.
+    '''
+    seasons = {} if seasons is None else seasons
+    sources = {} if sources is None else sources
+    table = concat(
+        [get_wyear_extrema_index(name,seasons.get(name),sources.get(name))['ANOM'].rename(name) for name in names],
+        axis=1,
+    )
+    table.index = table.index.astype(int)
+    return table.sort_index()
+
+def build_year_bitsets(teletable):
+    '''
+    Precompute year-selection bitsets for each column of the teleconnection table. Each water year
+    is given one bit. For each index the years are sorted by value and a running OR of their bits
+    is stored, so the set of years whose value falls inside an open interval is the XOR of two of
+    these prefix masks found by a binary search. Python ints are used so there is no limit on
+    the number of years.
+    '''
+    years = teletable.index.to_numpy()
+    bitsets = {'years': years, 'indices': {}}
+    for name in teletable.columns:
+        values = teletable[name].to_numpy(dtype=float)
+        order = np.argsort(values,kind='stable')
+        order = order[~np.isnan(values[order])]
+        prefix = [0]
+        for bit in order:
+            prefix.append(prefix[-1] | (1 << int(bit)))
+        bitsets['indices'][name] = (values[order],prefix)
+    return bitsets
+
+def select_years_bitmask(bitsets,ranges):
+    '''
+    Resolve a selection such as {'ONI': [-3,-0.5], 'PNA': [-3,0]} to a bitmask of the water years
+    that fall strictly inside every range. Indices are intersected with a bitwise AND.
+    '''
+    mask = (1 << len(bitsets['years'])) - 1
+    for name, (lower, upper) in ranges.items():
+        values, prefix = bitsets['indices'][name]
+        start = np.searchsorted(values,lower,side='right')
+        stop = np.searchsorted(values,upper,side='left')
+        if stop <= start:
+            return 0
+        mask &= prefix[stop] ^ prefix[start]
+    return mask
+
+def years_from_bitmask(bitsets,mask):
+    #Unpack the bits back to an array of water years
+    years = bitsets['years']
+    return years[[bool(mask >> bit & 1) for bit in range(len(years))]]
+
 def get_oni_startrange(mnxonidata):
     if mnxonidata.loc[mnxonidata.index[(len(mnxonidata)-1)],"ANOM"] > 0.5:
         return [0.5,3]
@@ -121,13 +443,33 @@ def get_median(series):
 #and all years of data. I'll probably write these individually outside of the functions first
 #and then when I am satisfied that they work okay, will place them inside the functions. Still
 #don't know how to effectively debug functions in python and especially not in Jupyter lab.
+def year_day_cube(df):
+    #Water years and a (year x hydrological day of year x station) array of the station columns of df
+    rowyears = df['hydrological_year'].to_numpy(dtype=int)
+    years = np.unique(rowyears)
+    rowdays = df['hydrodoy'].to_numpy(dtype=int)-1
+    cube = np.full((len(years),rowdays.max()+1,len(df.columns)-3),np.nan)
+    cube[np.searchsorted(years,rowyears),rowdays] = df.iloc[:,:-3].to_numpy(dtype=float)
+    return years, cube
+
+def annual_peaks(cube):
+    #Day index of each year and station's peak in the cube, with the peak; NaN peak where there are no data
+    peakidx = np.where(np.isnan(cube),-np.inf,cube).argmax(axis=1)
+    peak = np.take_along_axis(cube,peakidx[:,None,:],axis=1)[:,0,:]
+    return peakidx, peak
+
 def process_snow_maxima(df):
     '''
     Take the snow data frame as input and process for the timing and amplitude of peak snow for all stations
     and for all years. Output will be a dataframe with index of years and columns of stations containing max
     snow amount and a second data frame with the same organization but containing timing of max snow.
     '''
-    pass
+    years, cube = year_day_cube(df)
+    peakidx, peak = annual_peaks(cube)
+    peakday = (peakidx+1).astype(float)
+    peakday[np.isnan(peak)] = np.nan
+    index = Index(years,name='hydrological_year')
+    return DataFrame(peak,index=index,columns=df.columns[:-3]), DataFrame(peakday,index=index,columns=df.columns[:-3])
 
 def process_snowoff_day(df):
     '''
@@ -135,7 +477,13 @@ def process_snowoff_day(df):
     pandas dataframe with an index of years and columns per station with values of the hydrological day of year of
     snowpack loss.
     '''
-    pass
+    #The first day on or after the year's peak with no snow, NaN if the peak is zero or the snow never goes
+    years, cube = year_day_cube(df)
+    peakidx, peak = annual_peaks(cube)
+    snowoff = (np.arange(cube.shape[1])[None,:,None] >= peakidx[:,None,:]) & (cube <= 0)
+    snowoffday = (snowoff.argmax(axis=1)+1).astype(float)
+    snowoffday[~snowoff.any(axis=1) | ~(peak > 0)] = np.nan
+    return DataFrame(snowoffday,index=Index(years,name='hydrological_year'),columns=df.columns[:-3])
 
 def process_peak_snowmelt(df):
     '''
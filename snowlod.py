@@ -0,0 +1,57 @@
+import warnings
+import numpy as np
+
+'''
+Level of detail for the line chart on narrow screens. The daily series are thinned with
+largest-triangle-three-buckets (LTTB): the days are split into buckets and from each the day
+making the largest triangle with the day kept from the bucket before and the mean of the
+bucket after is kept, which holds on to peaks, troughs and melt-out where plain decimation
+would cut through them.
+
+lttb_rows works on all the columns of a (day x series) array together, one bucket at a time,
+so a station's years and quantiles are thinned in one pass. A bucket with no data in a
+column keeps one missing day, so gaps in the record still break the line.
+'''
+
+#Points drawn per pixel of viewport width, and never fewer points than this
+LOD_POINTS_PER_PIXEL = 0.25
+LOD_MIN_POINTS = 60
+
+def lod_points(viewportwidth,ndays):
+    #Points per series for a viewport width in pixels; None when every day fits or the width is unknown
+    if not viewportwidth:
+        return None
+    npoints = max(LOD_MIN_POINTS,int(viewportwidth*LOD_POINTS_PER_PIXEL))
+    return npoints if npoints < ndays else None
+
+def lttb_rows(values,npoints):
+    '''
+    Rows of the (day x series) array values kept by LTTB for each series, as an (npoints x
+    series) integer array in increasing order. The first and last days are always kept.
+    '''
+    ndays, nseries = values.shape
+    if npoints >= ndays or npoints < 3:
+        return np.repeat(np.arange(ndays)[:,None],nseries,axis=1)
+    edges = np.linspace(1,ndays-1,npoints-1).astype(int)
+    rows = np.zeros((npoints,nseries),dtype=int)
+    rows[-1] = ndays-1
+    columns = np.arange(nseries)
+    for k in range(npoints-2):
+        start, stop = edges[k], edges[k+1]
+        if k+2 < len(edges):
+            nextx = (edges[k+1]+edges[k+2]-1)/2
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore',category=RuntimeWarning)
+                nexty = np.nanmean(values[edges[k+1]:edges[k+2]],axis=0)
+        else:
+            nextx, nexty = ndays-1, values[-1]
+        prevx = rows[k]
+        prevy = values[prevx,columns]
+        #Missing neighbours stand in for each other, or for zero when both are missing
+        prevy = np.where(np.isnan(prevy),nexty,prevy)
+        nexty = np.nan_to_num(np.where(np.isnan(nexty),prevy,nexty))
+        prevy = np.nan_to_num(prevy)
+        bucketx = np.arange(start,stop)[:,None]
+        areas = np.abs((prevx-nextx)*(values[start:stop]-prevy)-(prevx-bucketx)*(nexty-prevy))
+        rows[k+1] = start+np.where(np.isnan(areas),-1.,areas).argmax(axis=0)
+    return rows
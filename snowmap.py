@@ -1,41 +1,72 @@
-def draw_station_map(go,locdfuse,anomstat):
+#How the station markers can be coloured when anomalies are shown: the locdfuse column used,
+#the colour range, the colour bar title and whether it depends on the selected ENSO years.
+MAP_COLOUR_MODES = {
+    'pct': {'column': 'pct_snow', 'cmin': 25., 'cmax': 175., 'cmid': 100., 'title': '% of normal', 'enso': False},
+    'rank': {'column': 'rank_full', 'cmin': 0., 'cmax': 100., 'cmid': 50., 'title': 'Percentile', 'enso': False},
+    'rankenso': {'column': 'rank_enso', 'cmin': 0., 'cmax': 100., 'cmid': 50., 'title': 'ENSO percentile', 'enso': True},
+    'ensoday': {'column': 'enso_day', 'cmin': 25., 'cmax': 175., 'cmid': 100., 'title': 'ENSO % of median', 'enso': True},
+    'ensopeak': {'column': 'enso_peak', 'cmin': 25., 'cmax': 175., 'cmid': 100., 'title': 'ENSO peak %', 'enso': True},
+    'trendpeak': {'column': 'trend_peak', 'cmin': -30., 'cmax': 30., 'cmid': 0., 'title': 'Peak %/decade', 'enso': False},
+    'trendpeakday': {'column': 'trend_peakday', 'cmin': -15., 'cmax': 15., 'cmid': 0., 'title': 'Peak date days/decade', 'enso': False},
+    'trendmelt': {'column': 'trend_melt', 'cmin': -15., 'cmax': 15., 'cmid': 0., 'title': 'Melt-out days/decade', 'enso': False},
+}
+#Columns of locdfuse passed to the hover template
+MAP_CUSTOMDATA = ['LCTN_NM','LCTN_ID','ELEVATION','pct_snow','rank_full','exceed_full','rank_enso','exceed_enso','enso_day','enso_peak',
+                  'trend_peak','trend_peak_p','trend_melt','trend_melt_p','trend_peakday','trend_peakday_p']
+
+def station_marker(locdfuse,anomstat,colourmode='pct'):
     '''
-    Function to draw a map of data from the location dataframe locdfuse using mapbox
-    map tiles. This function was offloaded from the main snowapp code
-    to lighten it up. May opt to pass in some styling at a later date, but for now
-    this serves the purpose.
+    Marker properties for the station trace: coloured by the colourmode column of locdfuse
+    when anomalies are shown, a single colour otherwise. Also used to patch the marker alone.
     '''
-    fig = go.Figure()
     if anomstat:
-        markeruse = go.scattermap.Marker(
+        colouring = MAP_COLOUR_MODES[colourmode]
+        return dict(
                 size = 18,
                 colorscale='RdBu',
-                color = locdfuse['pct_snow'],  #'rgba(0,175,245,0.7)'
-                opacity = 1.,
-                cmin = 25.,
-                cmax = 175.,
-                cmid = 100.,
-            )
-    else:
-        markeruse = go.scattermap.Marker(
-                size = 18,
-                color = 'rgba(0,175,245,0.7)',
+                color = locdfuse[colouring['column']].to_numpy(),  #'rgba(0,175,245,0.7)'
                 opacity = 1.,
-                cmin = 25.,
-                cmax = 175.,
-                cmid = 100.,
+                cmin = colouring['cmin'],
+                cmax = colouring['cmax'],
+                cmid = colouring['cmid'],
+                colorbar = dict(title=dict(text=colouring['title']), thickness=12),
             )
+    return dict(
+            size = 18,
+            color = 'rgba(0,175,245,0.7)',
+            opacity = 1.,
+            cmin = 25.,
+            cmax = 175.,
+            cmid = 100.,
+        )
+
+def draw_station_map(go,locdfuse,anomstat,colourmode='pct',layers=None):
+    '''
+    Function to draw a map of data from the location dataframe locdfuse using mapbox
+    map tiles. This function was offloaded from the main snowapp code
+    to lighten it up. May opt to pass in some styling at a later date, but for now
+    this serves the purpose. colourmode is one of the MAP_COLOUR_MODES and layers are
+    extra map layers such as the anomaly surface tiles.
+    '''
+    fig = go.Figure()
+    markeruse = go.scattermap.Marker(**station_marker(locdfuse,anomstat,colourmode))
     fig.add_trace(
         go.Scattermap(
             lon = locdfuse['LONGITUDE'],
             lat = locdfuse['LATITUDE'],
             text = locdfuse['text'],
             mode = 'markers',
-            customdata=locdfuse[['LCTN_NM','LCTN_ID','ELEVATION','pct_snow']],
+            customdata=locdfuse[MAP_CUSTOMDATA],
             hovertemplate="<b>%{customdata[0]}</b><br><br>"+
             "Station ID: %{customdata[1]}<br>"+
             "Elevation: %{customdata[2]}<br>"+
-            "Current Anomaly: %{customdata[3]:.0f}% of normal"+
+            "Anomaly: %{customdata[3]:.0f}% of normal<br>"+
+            "Percentile: %{customdata[4]:.0f} (%{customdata[6]:.0f} in selected ENSO years)<br>"+
+            "Exceedance: %{customdata[5]:.0f}% (%{customdata[7]:.0f}% in selected ENSO years)<br>"+
+            "ENSO years median: %{customdata[8]:.0f}% of median on date, %{customdata[9]:.0f}% at peak<br>"+
+            "Peak trend: %{customdata[10]:+.1f}% per decade (p = %{customdata[11]:.2f})<br>"+
+            "Peak date trend: %{customdata[14]:+.1f} days per decade (p = %{customdata[15]:.2f})<br>"+
+            "Melt-out trend: %{customdata[12]:+.1f} days per decade (p = %{customdata[13]:.2f})"+
             "<extra></extra>",
             marker=markeruse,
             selected = dict(
@@ -55,7 +86,7 @@ def draw_station_map(go,locdfuse,anomstat):
                          lon=-126
                       ),
             'style': 'open-street-map',
-            
+            'layers': [] if layers is None else layers,
         },
         margin = dict(l=0, r=0, b=0, t=0),
         map_bounds = {"west": -142, "east": -110, "south": 45, "north": 61},
@@ -1,7 +1,157 @@
 import time
+import numpy as np
 from snowdata import count_coverage
+from snowlod import lttb_rows
 
-def snow_lineplot(go,pd,subdf,yearsuse,currentyear,fillarea,fillline,plottitle):
+#Only the first 321 days of the water year are plotted and used to judge a year's completeness
+MAXDAYIDX = 321
+TARGET_QUANTILES = [
+    0.05,
+    0.1587,
+    0.25,
+    0.5,
+    0.75,
+    0.8413,
+    0.95
+]
+
+def complete_year_mask(subdf,maxdayidx=MAXDAYIDX):
+    '''
+    A year is complete if more than 95% of the plotted days have data. Returns a boolean Series
+    over the columns of subdf.
+    '''
+    return (1-(subdf.iloc[0:maxdayidx,:].isna().sum(axis='rows'))/maxdayidx)>0.95
+
+#Positions of the traces snow_lineplot always draws, so a Patch can address them. The
+#individual years follow the quantile lines, then come the analogs and the current year.
+FULL_RANGE_TRACE = 0
+SELECTED_RANGE_TRACE = 2
+SELECTED_MEDIAN_TRACE = 3
+YEAR_TRACE_START = 8
+
+def selected_years(subdf,yearsuse):
+    #The columns of subdf for the years in yearsuse
+    return subdf.loc[:,subdf.columns[subdf.columns.isin(yearsuse)]]
+
+def selected_quantiles(subdf,yearsuse,maxdayidx=MAXDAYIDX):
+    #Quantiles over the complete years of subdf in yearsuse
+    filtereddf = selected_years(subdf,yearsuse)
+    completestat = complete_year_mask(filtereddf,maxdayidx)
+    return filtereddf.loc[:,completestat].quantile(TARGET_QUANTILES,axis=1,interpolation='midpoint').transpose()
+
+def subset_quantiles(pd,subdf,yearsuse,subquantiles=None,maxdayidx=MAXDAYIDX):
+    '''
+    The years of subdf in yearsuse with their quantile columns appended (computed unless
+    subquantiles are given) and the number of those years.
+    '''
+    filtereddf = selected_years(subdf,yearsuse)
+    nyearssub = len(filtereddf.columns)
+    if subquantiles is None:
+        subquantiles = selected_quantiles(subdf,yearsuse,maxdayidx)
+    return pd.concat([filtereddf,subquantiles],axis=1,copy=False,), nyearssub
+
+def range_outline(pd,quantdf,maxdayidx=MAXDAYIDX):
+    #The 1 sigma band as a closed outline: along the lower quantile and back along the upper one
+    return pd.concat([quantdf[0.1587].iloc[0:maxdayidx],quantdf[0.8413].iloc[maxdayidx:0:-1]])
+
+def full_quantiles(subdf,quantiles=None,maxdayidx=MAXDAYIDX):
+    #Quantiles over the complete years of subdf, unless precomputed ones are given
+    if quantiles is None:
+        completestat = complete_year_mask(subdf,maxdayidx)
+        quantiles = subdf.loc[:,completestat].quantile(TARGET_QUANTILES,axis=1,interpolation='midpoint').transpose()
+    return quantiles
+
+def lod_rows(frame,npoints,maxdayidx=MAXDAYIDX):
+    #The plotted days of each column of frame kept at npoints per line, by column. None for every day.
+    if npoints is None:
+        return None
+    rows = lttb_rows(frame.iloc[0:maxdayidx,:].to_numpy(dtype=float),npoints)
+    return dict(zip(frame.columns,rows.T))
+
+def line_xy(frame,column,rows=None,maxdayidx=MAXDAYIDX):
+    #x and y of one line, every plotted day or the rows kept for it
+    if rows is None:
+        return frame.index.to_numpy()[0:maxdayidx], frame[column].to_numpy()[0:maxdayidx]
+    return frame.index.to_numpy()[rows[column]], frame[column].to_numpy()[rows[column]]
+
+def outline_xy(pd,quantdf,rows=None,maxdayidx=MAXDAYIDX):
+    #x and y of the 1 sigma outline, every plotted day or the rows kept for its two quantiles
+    if rows is None:
+        days = quantdf.index.to_series()
+        return pd.concat([days[0:maxdayidx],days[maxdayidx:0:-1]]).to_numpy(), range_outline(pd,quantdf,maxdayidx).to_numpy()
+    lowerx, lowery = line_xy(quantdf,0.1587,rows,maxdayidx)
+    upperx, uppery = line_xy(quantdf,0.8413,rows,maxdayidx)
+    return np.concatenate([lowerx,upperx[::-1]]), np.concatenate([lowery,uppery[::-1]])
+
+def lod_lines(pd,subdf,filtereddf,yearsplot,npoints=None,lodrows=None,maxdayidx=MAXDAYIDX):
+    '''
+    x and y of the lines that are thinned on narrow screens, in trace order: the full and
+    selected ranges and medians, the four quantile lines and the past years. subdf carries
+    the full-record quantile columns and filtereddf the selection's. lodrows are lod_rows of
+    subdf, computed here when npoints is given without them.
+    '''
+    if (npoints is not None) and (lodrows is None):
+        lodrows = lod_rows(subdf,npoints,maxdayidx)
+    sublodrows = lod_rows(filtereddf[TARGET_QUANTILES],npoints,maxdayidx)
+    lines = [
+        outline_xy(pd,subdf,lodrows,maxdayidx),
+        line_xy(subdf,0.5,lodrows,maxdayidx),
+        outline_xy(pd,filtereddf,sublodrows,maxdayidx),
+        line_xy(filtereddf,0.5,sublodrows,maxdayidx),
+    ]
+    lines += [line_xy(subdf,TARGET_QUANTILES[i],lodrows,maxdayidx) for i in [0,2,4,6]]
+    lines += [line_xy(subdf,ayear,lodrows,maxdayidx) for ayear in yearsplot]
+    return lines
+
+def year_columns(subdf,currentyear):
+    #The past years drawn as individual traces; the current year has its own trace
+    return [ayear for ayear in subdf.columns if ayear not in currentyear.values]
+
+def snow_lineplot_restyle(Patch,fillarea,fillline,plottitle):
+    #Patch of the selection colours and title alone, for a new slider range with the same years
+    patched = Patch()
+    patched['data'][SELECTED_RANGE_TRACE]['fillcolor'] = fillarea
+    patched['data'][SELECTED_MEDIAN_TRACE]['line']['color'] = fillline
+    patched['layout']['title']['text'] = plottitle
+    return patched
+
+def snow_lineplot_patch(Patch,pd,subdf,yearsuse,currentyear,fillarea,fillline,plottitle,subquantiles=None,npoints=None):
+    '''
+    Move a figure drawn by snow_lineplot for the same station to a new ENSO selection. Only
+    the selected range and median, the visibility of the individual years and the title
+    change, so only those go in the Patch. Dash's Patch is passed in like go and pd are.
+    npoints is the level of detail the figure is drawn at, None for every day.
+    '''
+    maxdayidx = MAXDAYIDX
+    filtereddf, nyearssub = subset_quantiles(pd,subdf,yearsuse,subquantiles,maxdayidx)
+    sublodrows = lod_rows(filtereddf[TARGET_QUANTILES],npoints,maxdayidx)
+
+    patched = snow_lineplot_restyle(Patch,fillarea,fillline,plottitle)
+    patched['data'][SELECTED_RANGE_TRACE]['x'], patched['data'][SELECTED_RANGE_TRACE]['y'] = outline_xy(pd,filtereddf,sublodrows,maxdayidx)
+    patched['data'][SELECTED_RANGE_TRACE]['visible'] = bool(nyearssub >= 5)
+    patched['data'][SELECTED_MEDIAN_TRACE]['x'], patched['data'][SELECTED_MEDIAN_TRACE]['y'] = line_xy(filtereddf,0.5,sublodrows,maxdayidx)
+    for k, ayear in enumerate(year_columns(subdf,currentyear)):
+        patched['data'][YEAR_TRACE_START+k]['visible'] = 'legendonly' if ayear in yearsuse else False
+    return patched
+
+def snow_lineplot_resolution(Patch,pd,subdf,yearsuse,currentyear,quantiles=None,subquantiles=None,npoints=None,lodrows=None):
+    '''
+    Patch of the x and y of every line snow_lineplot thins, redrawn at npoints per line, or
+    at every day when npoints is None, for the same station and selection. lodrows are the
+    lod_rows of the station's years and full-record quantiles if already known.
+    '''
+    maxdayidx = MAXDAYIDX
+    filtereddf = subset_quantiles(pd,subdf,yearsuse,subquantiles,maxdayidx)[0]
+    yearsplot = year_columns(subdf,currentyear)
+    subdf = pd.concat([subdf,full_quantiles(subdf,quantiles,maxdayidx)],axis=1,copy=False,)
+    patched = Patch()
+    for k, (x, y) in enumerate(lod_lines(pd,subdf,filtereddf,yearsplot,npoints,lodrows,maxdayidx)):
+        patched['data'][k]['x'] = x
+        patched['data'][k]['y'] = y
+    return patched
+
+def snow_lineplot(go,pd,subdf,yearsuse,currentyear,fillarea,fillline,plottitle,quantiles=None,subquantiles=None,analogs=None,analogday=0,
+                  npoints=None,lodrows=None):
     '''
     This is the line plotting function stripped out of the snowapp to simplify that code somewhat.
     Has dependencies on pandas and plotly graph objcts, so these are brought in
@@ -13,17 +163,16 @@ def snow_lineplot(go,pd,subdf,yearsuse,currentyear,fillarea,fillline,plottitle):
     fillarea:
     filline:
     plottitle:
+    quantiles: optional precomputed full-record quantiles (rows like subdf, a column per quantile)
+    subquantiles: optional precomputed quantiles for the yearsuse subset
+    analogs: optional analog years, closest first, highlighted with their rest-of-season range
+    analogday: row of subdf for today, where the analogs' rest of season starts
+    npoints: optional level of detail, the points per line the ranges, quantiles and past
+        years are thinned to with LTTB for narrow screens. None draws every day.
+    lodrows: optional lod_rows of subdf with the full-record quantiles for npoints
     '''
-    maxdayidx = 321
-    target_quantiles = [
-        0.05,
-        0.1587,
-        0.25,
-        0.5,
-        0.75,
-        0.8413,
-        0.95
-    ]
+    maxdayidx = MAXDAYIDX
+    target_quantiles = TARGET_QUANTILES
 #    quant_colors = [
 #        'rgba(244,0,0,0.8)', 
 #        'rgba(252,78,42,0.8)', 
@@ -60,63 +209,59 @@ def snow_lineplot(go,pd,subdf,yearsuse,currentyear,fillarea,fillline,plottitle):
 
     nyears = len(subdf.columns)
     
-    completestat = (1-(subdf.iloc[0:maxdayidx,:].isna().sum(axis='rows'))/maxdayidx)>0.95
     '''
     we have to calculate the quantiles on all years except the current
     and incomplete years. Partial years make weird quantiles where data
     drops in and out.
     '''
-    quantiles = subdf.loc[:,completestat].quantile(target_quantiles,axis=1,interpolation='midpoint').transpose()
+    quantiles = full_quantiles(subdf,quantiles,maxdayidx)
+    filtereddf, nyearssub = subset_quantiles(pd,subdf,yearsuse,subquantiles,maxdayidx)
+    yearsplot = year_columns(subdf,currentyear)
     subdf = pd.concat([subdf,quantiles],axis=1,copy=False,)
-
-
-    yearsavail = subdf.columns[subdf.columns.isin(yearsuse)]
-    filtereddf = subdf.loc[:,yearsavail]
-    nyearssub = len(filtereddf.columns)
-    completestat = (1-(filtereddf.iloc[0:maxdayidx,:].isna().sum(axis='rows'))/maxdayidx)>0.95
-    quantiles = filtereddf.loc[:,completestat].quantile(target_quantiles,axis=1,interpolation='midpoint').transpose()
-    filtereddf = pd.concat([filtereddf,quantiles],axis=1,copy=False,)
+    #x and y of the ranges, quantiles and past years, thinned when npoints is given
+    lines = lod_lines(pd,subdf,filtereddf,yearsplot,npoints,lodrows,maxdayidx)
     
     fig = go.Figure()
     #These next four add_trace/go.Scatter calls/objects build the median and range lines/area plots.
     #Range for the full dataset.
-    #Only plot ranges if more than 5 years of record
-    if nyears >= 5:
-        fig.add_trace(go.Scatter(
-            x=pd.concat([subdf.index.to_series()[0:maxdayidx],subdf.index.to_series()[maxdayidx:0:-1]]),
-            y=pd.concat([subdf[0.1587].iloc[0:maxdayidx],subdf[0.8413].iloc[maxdayidx:0:-1]]),
-            fill='toself',
-            fillcolor='rgba(100,100,100,0.2)',
-            line_color='rgba(255,255,255,0)',
-            legendgroup='fullrecord',
-            showlegend=True,
-            name="1" + u"\u03C3"+" Range"
-        ))
+    #Only show ranges if more than 5 years of record. The range traces are always there,
+    #hidden when too short, so the traces after them keep their positions for a Patch.
+    fig.add_trace(go.Scatter(
+        x=lines[FULL_RANGE_TRACE][0],
+        y=lines[FULL_RANGE_TRACE][1],
+        visible=bool(nyears >= 5),
+        fill='toself',
+        fillcolor='rgba(100,100,100,0.2)',
+        line_color='rgba(255,255,255,0)',
+        legendgroup='fullrecord',
+        showlegend=True,
+        name="1" + u"\u03C3"+" Range"
+    ))
     #Median for the full dataset
     fig.add_trace(go.Scatter(
-        x=subdf.index.to_series()[0:maxdayidx],
-        y=subdf[0.5].iloc[0:maxdayidx],
+        x=lines[1][0],
+        y=lines[1][1],
         #y=subdf.iloc[:,0:(nyears-statoffset)].median(axis=1)[0:maxdayidx],
         line_color='rgb(100,100,100)',
         legendgroup='fullrecord',
         name='Median'
     ))
-    if nyearssub >= 5:
-        #Range for the ENSO subset of the data.
-        fig.add_trace(go.Scatter(
-            x=pd.concat([subdf.index.to_series()[0:maxdayidx],subdf.index.to_series()[maxdayidx:0:-1]]),
-            y=pd.concat([filtereddf[0.1587].iloc[0:maxdayidx],filtereddf[0.8413].iloc[maxdayidx:0:-1]]),
-            fill='toself',
-            fillcolor=fillarea,
-            line_color='rgba(255,255,255,0)',
-            legendgroup='onisub',
-            showlegend=True,
-            name="1" + u"\u03C3"+" Selected Range"
-        ))
+    #Range for the ENSO subset of the data.
+    fig.add_trace(go.Scatter(
+        x=lines[SELECTED_RANGE_TRACE][0],
+        y=lines[SELECTED_RANGE_TRACE][1],
+        visible=bool(nyearssub >= 5),
+        fill='toself',
+        fillcolor=fillarea,
+        line_color='rgba(255,255,255,0)',
+        legendgroup='onisub',
+        showlegend=True,
+        name="1" + u"\u03C3"+" Selected Range"
+    ))
     #Median for the ENSO subset of the data.
     fig.add_trace(go.Scatter(
-        x=subdf.index.to_series()[0:maxdayidx],
-        y=filtereddf[0.5].iloc[0:maxdayidx],
+        x=lines[SELECTED_MEDIAN_TRACE][0],
+        y=lines[SELECTED_MEDIAN_TRACE][1],
         #y=filtereddf.iloc[:,0:(nyearssub-statoffset)].median(axis=1)[0:maxdayidx],
         line_color=fillline,
         legendgroup='onisub',
@@ -128,19 +273,12 @@ def snow_lineplot(go,pd,subdf,yearsuse,currentyear,fillarea,fillline,plottitle):
     # 2) When the data are stratified by ENSO, add to the figure with attribute visible='legendonly'
     #    Like this:
 
-    #Okay, need to always plot the current year and not plot the current year a second time if
-    #The current year is included in the filtered data frame.
-    if any((currentyear.isin(yearsavail))):
-        #Deindex this by one so that the current year isn't plotted twice when the ENSO selection includes the
-        #ENSO value of the current year.
-        yearsavail = yearsavail[0:(len(yearsavail)-1)]
-
     #Put the 0.05, 0.25, 0.75, 0.95 quantiles on the plot
-    for i in [0,2,4,6]:
+    for k, i in enumerate([0,2,4,6]):
         fig.add_trace(
             go.Scatter(
-                x=subdf.index.to_series()[0:maxdayidx],
-                y=subdf[target_quantiles[i]].iloc[0:maxdayidx],
+                x=lines[4+k][0],
+                y=lines[4+k][1],
                 visible='legendonly',
                 name='{percentile:0.1f}%-ile'.format(percentile = 100*target_quantiles[i]),
                 legend='legend3',
@@ -148,17 +286,45 @@ def snow_lineplot(go,pd,subdf,yearsuse,currentyear,fillarea,fillline,plottitle):
                 #line=dict(color=quant_colors[i], width=3, dash=quant_dashstyle[i]),
             )
         )
-    for ayear in yearsavail:
+    #Every past year gets a trace, hidden outright when it isn't in the ENSO selection, so a
+    #new selection only flips visibilities. The current year is plotted once, further down.
+    for k, ayear in enumerate(yearsplot):
         fig.add_trace(
             go.Scatter(
-                x=filtereddf.index.to_series()[0:maxdayidx],
-                y=filtereddf[ayear].iloc[0:maxdayidx],
-                visible='legendonly',
+                x=lines[YEAR_TRACE_START+k][0],
+                y=lines[YEAR_TRACE_START+k][1],
+                visible='legendonly' if ayear in yearsuse else False,
                 name=str(int(ayear)),
                 legend='legend2',
             )
         )
 
+    #Highlight the analog years and shade their spread over the rest of the season
+    if (analogs is not None) and (len(analogs) > 0):
+        analogdf = subdf.loc[:,list(analogs)]
+        restdays = subdf.index.to_series()[analogday:maxdayidx]
+        fig.add_trace(go.Scatter(
+            x=pd.concat([restdays,restdays[::-1]]),
+            y=pd.concat([analogdf.iloc[analogday:maxdayidx,:].max(axis=1),analogdf.iloc[analogday:maxdayidx,:].min(axis=1)[::-1]]),
+            fill='toself',
+            fillcolor='rgba(255,147,79,0.25)',
+            line_color='rgba(255,255,255,0)',
+            legendgroup='analogs',
+            legend='legend3',
+            name='Analog Range'
+        ))
+        for ayear in analogs:
+            fig.add_trace(
+                go.Scatter(
+                    x=subdf.index.to_series()[0:maxdayidx],
+                    y=analogdf[ayear].iloc[0:maxdayidx],
+                    name='{} analog'.format(int(ayear)),
+                    line=dict(color='rgba(255,147,79,0.9)', width=2),
+                    legendgroup='analogs',
+                    legend='legend3',
+                )
+            )
+
     #Finally, plot the current year on the chart if the station is active.
     if station_is_active:
         fig.add_trace(
@@ -212,4 +378,7 @@ def snow_lineplot(go,pd,subdf,yearsuse,currentyear,fillarea,fillline,plottitle):
             x=0.85,
         )
     )
+    if npoints is not None:
+        #Thinned lines each keep different days, so pin the day order rather than take it from the traces
+        fig.update_xaxes(categoryorder='array',categoryarray=subdf.index.to_numpy()[0:maxdayidx])
     return fig
@@ -0,0 +1,151 @@
+import os
+import pickle
+import numpy as np
+from os.path import isfile
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from pandas import concat
+from snowdata import count_coverage, process_snow_maxima, process_snowoff_day
+from snowtrend import station_trends
+from snowbands import build_station_bands, slider_grid, write_quantile_bands, QUANTILE_BANDS_FILE
+
+'''
+Precompute pipeline for the per-station derived data: complete-year counts, peak annual snow
+and its date, melt-out days, the daily climatology, percent of normal, the long-term trends in
+peak snow, peak date and melt-out and the ENSO-subset quantile bands.
+
+Every one of these is computed station by station, so the station columns are split into
+shards and farmed out to a process pool. The shards are put back together in the original
+column order, which gives the same frames as running the whole dataframe through in one go.
+The worker count comes from the SNOWAPP_PRECOMPUTE_WORKERS environment variable (default 1,
+which runs in-process without a pool) or the command line.
+
+Build the artifacts with:
+    python snowprecompute.py [workers]
+'''
+
+DERIVED_DATA_FILE = './snow/derived_data.pkl'
+#Keys of the derived data besides the bands; an artifact missing any of them is rebuilt
+DERIVED_KEYS = ['nyears_complete','peak_annual_snow','historical_median_snow','snow_pct_median','peak_day','snowoff_day','peak_trend','peak_day_trend','snowoff_trend']
+PRECOMPUTE_WORKERS = int(os.environ.get('SNOWAPP_PRECOMPUTE_WORKERS','1'))
+#The non-station columns at the end of the snow dataframe
+EXTRA_COLUMNS = ['hydrodoy','hydrological_year','month-day']
+
+def derive_snow_statistics(df):
+    '''
+    Compute the derived data for every station column in df, which has the layout returned by
+    prepare_snow_data (station columns followed by EXTRA_COLUMNS).
+    '''
+    #Find the number of years with more than 80% data coverage.
+    complete_years = df.groupby(by="hydrological_year").apply(count_coverage,include_groups=False)*100/365 > 80
+    nyears_complete = complete_years.sum(axis='rows')
+    nyears_complete = nyears_complete[:-2]
+    #Get the peak snow each year and its hydrological day of year:
+    peak_annual_snow, peak_day = process_snow_maxima(df)
+    snowoff_day = process_snowoff_day(df)
+    #Trends over the complete years before the current one
+    trend_years = complete_years[peak_annual_snow.columns].copy()
+    trend_years.iloc[-1] = False
+
+    #keep the index
+    dftest = df.set_index(['hydrodoy'],append=True).iloc[:,:-2]
+    historical_median_snow = dftest.rolling(window=5,center=True).mean().groupby(level=1).mean()
+
+    snow_pct_median = 100*(dftest/historical_median_snow)
+    snow_pct_median.replace([np.inf], 399, inplace=True)
+    snow_pct_median[snow_pct_median > 399] = 400
+
+    return {
+        'nyears_complete': nyears_complete,
+        'peak_annual_snow': peak_annual_snow,
+        'historical_median_snow': historical_median_snow,
+        'snow_pct_median': snow_pct_median,
+        'peak_day': peak_day,
+        'snowoff_day': snowoff_day,
+        'peak_trend': station_trends(peak_annual_snow,trend_years),
+        'peak_day_trend': station_trends(peak_day,trend_years),
+        'snowoff_trend': station_trends(snowoff_day,trend_years),
+    }
+
+def derive_station_shard(shard,teleseries=None,grid=None):
+    #Work done by one pool worker. Quantile bands are only built when given the slider index.
+    derived = derive_snow_statistics(shard)
+    if teleseries is not None:
+        derived['bands'] = {stnname: build_station_bands(shard,stnname,teleseries,grid) for stnname in shard.columns[:-len(EXTRA_COLUMNS)]}
+    return derived
+
+def station_shards(df,nshards):
+    #Split the station columns into nshards contiguous groups, each carrying the extra columns
+    stations = df.columns[:-len(EXTRA_COLUMNS)]
+    return [df[list(group) + EXTRA_COLUMNS] for group in np.array_split(stations,nshards) if len(group) > 0]
+
+def precompute_derived(df,teleseries=None,workers=PRECOMPUTE_WORKERS,grid=None):
+    '''
+    Compute the derived data, sharded by station across workers processes. With workers of 1
+    the whole dataframe is processed in this process.
+    '''
+    if (teleseries is not None) and (grid is None):
+        grid = slider_grid()
+    if workers <= 1:
+        return derive_station_shard(df,teleseries,grid)
+
+    #A few shards per worker keeps the pool busy when stations have very different record lengths
+    shards = station_shards(df,workers*4)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(derive_station_shard,shards,repeat(teleseries),repeat(grid)))
+
+    derived = {
+        'nyears_complete': concat([result['nyears_complete'] for result in results]),
+        'peak_annual_snow': concat([result['peak_annual_snow'] for result in results],axis=1),
+        'historical_median_snow': concat([result['historical_median_snow'] for result in results],axis=1),
+        'snow_pct_median': concat([result['snow_pct_median'] for result in results],axis=1),
+        'peak_day': concat([result['peak_day'] for result in results],axis=1),
+        'snowoff_day': concat([result['snowoff_day'] for result in results],axis=1),
+        'peak_trend': concat([result['peak_trend'] for result in results]),
+        'peak_day_trend': concat([result['peak_day_trend'] for result in results]),
+        'snowoff_trend': concat([result['snowoff_trend'] for result in results]),
+    }
+    if teleseries is not None:
+        derived['bands'] = {}
+        for result in results:
+            derived['bands'].update(result['bands'])
+    return derived
+
+def write_derived_data(derived,dataversion,filename=DERIVED_DATA_FILE,bandsfilename=QUANTILE_BANDS_FILE):
+    '''
+    Write the derived frames to one pickle and, if they were built, the quantile bands to the
+    bands file. dataversion, from data_version, tags both with the data they came from.
+    '''
+    frames = {key: value for key, value in derived.items() if key != 'bands'}
+    frames['dataversion'] = dataversion
+    with open(filename,'wb') as derivedfile:
+        pickle.dump(frames,derivedfile,protocol=pickle.HIGHEST_PROTOCOL)
+    if 'bands' in derived:
+        stations = list(derived['bands'].keys())
+        write_quantile_bands(derived['bands'],stations,dataversion,bandsfilename)
+    return filename
+
+def load_derived_data(filename=DERIVED_DATA_FILE,dataversion=None):
+    #Returns None if there is no artifact, it was built from different data or it predates some of the DERIVED_KEYS
+    if not isfile(filename):
+        return None
+    with open(filename,'rb') as derivedfile:
+        derived = pickle.load(derivedfile)
+    builtfrom = derived.pop('dataversion',None)
+    if (dataversion is not None) and (builtfrom != dataversion):
+        return None
+    if not all(key in derived for key in DERIVED_KEYS):
+        return None
+    return derived
+
+if __name__ == '__main__':
+    import sys
+    import time
+    from snowdata import prepare_snow_data, get_teleconnection_table, data_version
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else PRECOMPUTE_WORKERS
+    df, locdf, stations_with_current_year = prepare_snow_data()
+    teletable = get_teleconnection_table(['ONI'])
+    starttime = time.time()
+    derived = precompute_derived(df,teletable['ONI'],workers=workers)
+    write_derived_data(derived,data_version(df))
+    print('Precomputed {} stations with {} workers in {:.1f} s'.format(len(derived['bands']),workers,time.time()-starttime))
@@ -0,0 +1,76 @@
+import numpy as np
+
+'''
+Empirical percentile rank and exceedance probability of a day's SWE against the complete
+historical years for the same day of the water year.
+
+The complete-year values are held presorted in a (day x station x year) table. Each station's
+row is shifted by RANK_OFFSET and gaps are filled with RANK_FILL, so a day's rows laid end to
+end form one ascending array and every station is ranked by a single searchsorted call. The
+year of each sorted value is kept alongside, which lets an ENSO subset be ranked from a
+cumulative count of its years without re-sorting.
+
+Ranks are mid-ranks in percent, so ties count half, and the exceedance probability is its
+complement: the chance of a year in the reference set having more snow on that day.
+'''
+
+RANK_OFFSET = 1.e6
+RANK_FILL = 1.e5
+
+def build_rank_table(yearcube,currentyear):
+    '''
+    Build the presorted table from the (station x year x day) cube of build_year_cube. Only
+    complete years are ranked against and currentyear is left out.
+    '''
+    keep = yearcube['years'] != currentyear
+    years = yearcube['years'][keep]
+    values = yearcube['values'][:,keep,:].copy()
+    values[~yearcube['complete'][:,keep],:] = np.nan
+    stations = list(yearcube['stations'].keys())
+
+    #Sort the years for each station and day, gaps last
+    values = values.transpose(2,0,1)
+    order = np.argsort(values,axis=2,kind='stable')
+    ordered = np.take_along_axis(values,order,axis=2)
+    nvalid = (~np.isnan(ordered)).sum(axis=2)
+    ordered[np.isnan(ordered)] = RANK_FILL
+    ordered += (RANK_OFFSET*np.arange(len(stations)))[None,:,None]
+
+    return {
+        'sorted': ordered,
+        'yearidx': order.astype(np.int16),
+        'nvalid': nvalid,
+        'years': years,
+        'stations': yearcube['stations'],
+    }
+
+def rank_swe(ranktable,swe,dayidx,yearsuse=None):
+    '''
+    Rank each station's swe (ordered like the table's stations) for day of water year dayidx.
+    yearsuse restricts the reference years, e.g. to an ENSO subset. Returns the percentile
+    ranks and the exceedance probabilities, NaN where there is no value or reference year.
+    '''
+    daysorted = ranktable['sorted'][dayidx]
+    nstations, nyears = daysorted.shape
+    offsets = RANK_OFFSET*np.arange(nstations)
+    rowstart = nyears*np.arange(nstations)
+    target = np.asarray(swe,dtype=float)+offsets
+    less = np.searchsorted(daysorted.ravel(),target,side='left')-rowstart
+    lessequal = np.searchsorted(daysorted.ravel(),target,side='right')-rowstart
+
+    if yearsuse is None:
+        nyearsuse = ranktable['nvalid'][dayidx]
+    else:
+        #Count the subset's years below each position in the sorted rows
+        member = np.isin(ranktable['years'],yearsuse)[ranktable['yearidx'][dayidx]]
+        member &= np.arange(nyears)[None,:] < ranktable['nvalid'][dayidx][:,None]
+        counts = np.concatenate([np.zeros((nstations,1),dtype=int),np.cumsum(member,axis=1)],axis=1)
+        rows = np.arange(nstations)
+        nyearsuse = counts[:,-1]
+        less = counts[rows,np.clip(less,0,nyears)]
+        lessequal = counts[rows,np.clip(lessequal,0,nyears)]
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        rank = 100*(less+0.5*(lessequal-less))/nyearsuse
+    rank[np.isnan(target) | (nyearsuse == 0)] = np.nan
+    return rank, 100-rank
@@ -0,0 +1,112 @@
+import numpy as np
+
+'''
+Spatial index over the station locations for resolving map clicks, URL parameters and the
+station search box to a station.
+
+Stations are bucketed on a regular latitude/longitude grid and stored sorted by cell, with the
+start of each cell's run found by binary search, so box and radius queries only look at the
+cells they overlap. Nearest-N queries grow a radius search until it holds N stations. There is
+also a lookup table from LCTN_ID to station. Distances are great-circle kilometres.
+'''
+
+EARTH_RADIUS_KM = 6371.
+STATION_CELL_DEGREES = 0.5
+
+def build_station_index(locdf,cellsize=STATION_CELL_DEGREES):
+    '''
+    Index the stations in the location dataframe (LCTN_ID, LCTN_NM, LATITUDE, LONGITUDE and
+    DATA_COLUMN columns). column is the station's column name in the snow dataframe.
+    '''
+    lat = locdf['LATITUDE'].to_numpy(dtype=float)
+    lon = locdf['LONGITUDE'].to_numpy(dtype=float)
+    rows = np.floor((lat+90)/cellsize).astype(np.int64)
+    cols = np.floor((lon+180)/cellsize).astype(np.int64)
+    ncols = int(np.ceil(360/cellsize))
+    cells = rows*ncols+cols
+    order = np.argsort(cells,kind='stable')
+
+    ids = locdf['LCTN_ID'].to_numpy()[order]
+    return {
+        'lat': lat[order],
+        'lon': lon[order],
+        'cells': cells[order],
+        'ids': ids,
+        'names': locdf['LCTN_NM'].to_numpy()[order],
+        'columns': locdf['DATA_COLUMN'].to_numpy()[order],
+        'byid': {stationid: k for k, stationid in enumerate(ids)},
+        'cellsize': cellsize,
+        'ncols': ncols,
+    }
+
+def great_circle_km(lat1,lon1,lat2,lon2):
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    haversine = np.sin((lat2-lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2)**2
+    return 2*EARTH_RADIUS_KM*np.arcsin(np.sqrt(np.clip(haversine,0,1)))
+
+def _cells_in_bbox(stationindex,west,south,east,north):
+    #Positions in the sorted station arrays of every station in the cells overlapping the box
+    cellsize = stationindex['cellsize']
+    rowrange = np.arange(np.floor((max(south,-90)+90)/cellsize),np.floor((min(north,90)+90)/cellsize)+1).astype(np.int64)
+    colrange = np.arange(np.floor((west+180)/cellsize),np.floor((east+180)/cellsize)+1).astype(np.int64) % stationindex['ncols']
+    cells = (rowrange[:,None]*stationindex['ncols']+np.unique(colrange)[None,:]).ravel()
+    starts = np.searchsorted(stationindex['cells'],cells,side='left')
+    stops = np.searchsorted(stationindex['cells'],cells,side='right')
+    if len(cells) == 0:
+        return np.array([],dtype=np.int64)
+    return np.concatenate([np.arange(start,stop) for start, stop in zip(starts,stops)])
+
+def stations_in_bbox(stationindex,west,south,east,north):
+    #Positions of the stations inside a longitude/latitude box
+    candidates = _cells_in_bbox(stationindex,west,south,east,north)
+    lat, lon = stationindex['lat'][candidates], stationindex['lon'][candidates]
+    return candidates[(lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)]
+
+def stations_within(stationindex,lat,lon,radiuskm):
+    '''
+    Positions of the stations within radiuskm of a point and their distances, nearest first.
+    '''
+    dlat = np.degrees(radiuskm/EARTH_RADIUS_KM)
+    #Longitude degrees shrink toward the poles; the whole circle of longitude past ~89 degrees
+    coslat = np.cos(np.radians(min(abs(lat)+dlat,89.)))
+    dlon = min(np.degrees(radiuskm/(EARTH_RADIUS_KM*coslat)),180.)
+    candidates = _cells_in_bbox(stationindex,lon-dlon,lat-dlat,lon+dlon,lat+dlat)
+    distances = great_circle_km(lat,lon,stationindex['lat'][candidates],stationindex['lon'][candidates])
+    keep = distances <= radiuskm
+    order = np.argsort(distances[keep],kind='stable')
+    return candidates[keep][order], distances[keep][order]
+
+def nearest_stations(stationindex,lat,lon,count=1):
+    '''
+    Positions of the count stations nearest a point and their distances. The search radius
+    doubles until it holds count stations; everything outside it is farther away.
+    '''
+    count = min(count,len(stationindex['ids']))
+    radiuskm = stationindex['cellsize']*111.
+    while True:
+        positions, distances = stations_within(stationindex,lat,lon,radiuskm)
+        if (len(positions) >= count) or (radiuskm > np.pi*EARTH_RADIUS_KM):
+            return positions[0:count], distances[0:count]
+        radiuskm *= 2
+
+def lookup_station(stationindex,stationid):
+    #Position of a station by its LCTN_ID, or None
+    return stationindex['byid'].get(stationid)
+
+def search_stations(stationindex,text,count=10):
+    '''
+    Resolve search box text to station positions. Accepts "lat, lon" for the nearest stations,
+    a station ID or the start of one, or part of a station name.
+    '''
+    text = text.strip()
+    try:
+        lat, lon = [float(part) for part in text.replace(',',' ').split()]
+        return nearest_stations(stationindex,lat,lon,count)[0]
+    except ValueError:
+        pass
+    if text.upper() in stationindex['byid']:
+        return np.array([stationindex['byid'][text.upper()]])
+    lowered = text.lower()
+    matches = [k for k, (stationid, name) in enumerate(zip(stationindex['ids'],stationindex['names']))
+               if stationid.lower().startswith(lowered) or (lowered in name.lower())]
+    return np.array(matches[0:count],dtype=np.int64)
@@ -0,0 +1,86 @@
+import numpy as np
+from snowplot import MAXDAYIDX, TARGET_QUANTILES, complete_year_mask, subset_quantiles
+from snowbands import lookup_quantile_bands
+
+'''
+Network summary of how the median snow season in the selected ENSO years compares with the full
+record at every station: the size and date of the median peak and the median melt-out date.
+
+This goes station by station through the same pivots and quantiles as the line chart, so over
+the whole network it takes seconds rather than milliseconds. The app runs it as a background
+callback, with progress reported after each station.
+'''
+
+#Column id and heading of the summary table
+SUMMARY_COLUMNS = [
+    ('LCTN_ID', 'Station ID'),
+    ('LCTN_NM', 'Name'),
+    ('nyears', 'Complete years'),
+    ('nyears_enso', 'ENSO years'),
+    ('peak_full', 'Median peak (mm)'),
+    ('peak_enso', 'ENSO median peak (mm)'),
+    ('peak_pct', 'ENSO peak (% of median)'),
+    ('peakday_full', 'Median peak date'),
+    ('peakday_enso', 'ENSO peak date'),
+    ('meltout_full', 'Median melt-out'),
+    ('meltout_enso', 'ENSO melt-out'),
+]
+
+def median_season(median,days):
+    '''
+    Peak SWE, peak date and melt-out date (the first day after the peak with no snow) of a
+    median curve over the plotted days. None for what can't be found.
+    '''
+    median = np.asarray(median,dtype=float)[0:MAXDAYIDX]
+    if np.isnan(median).all():
+        return None, None, None
+    peakidx = int(np.nanargmax(median))
+    meltidx = np.flatnonzero(median[peakidx:] <= 0)
+    meltout = days[peakidx+meltidx[0]] if len(meltidx) > 0 else None
+    return round(float(median[peakidx]),1), days[peakidx], meltout
+
+def station_summary(pd,subdf,yearsuse,bands=None):
+    '''
+    One row of the summary for a station's pivot of SWE by water year. bands are the (full,
+    subset) quantile arrays from lookup_quantile_bands, computed here when None.
+    '''
+    completestat = complete_year_mask(subdf,MAXDAYIDX)
+    if bands is None:
+        full = subdf.loc[:,completestat].quantile(TARGET_QUANTILES,axis=1,interpolation='midpoint').transpose()
+        subset = subset_quantiles(pd,subdf,yearsuse)[0]
+        fullmedian, subsetmedian = full[0.5].to_numpy(), subset[0.5].to_numpy()
+    else:
+        medianidx = TARGET_QUANTILES.index(0.5)
+        fullmedian, subsetmedian = bands[0][:,medianidx], bands[1][:,medianidx]
+
+    days = list(subdf.index)
+    peak_full, peakday_full, meltout_full = median_season(fullmedian,days)
+    peak_enso, peakday_enso, meltout_enso = median_season(subsetmedian,days)
+    return {
+        'nyears': int(completestat.sum()),
+        'nyears_enso': int((completestat & subdf.columns.isin(yearsuse)).sum()),
+        'peak_full': peak_full,
+        'peak_enso': peak_enso,
+        'peak_pct': round(100*peak_enso/peak_full) if (peak_full and peak_enso is not None) else None,
+        'peakday_full': peakday_full,
+        'peakday_enso': peakday_enso,
+        'meltout_full': meltout_full,
+        'meltout_enso': meltout_enso,
+    }
+
+def network_summary(pd,df,locdfuse,yearsuse,pivot,bandsfile=None,onirange=None,progress=None):
+    '''
+    Summary rows for every station in locdfuse. pivot(df,stnname) gives a station's pivot by
+    water year. The quantile bands in bandsfile are used when they cover onirange. progress,
+    if given, is called with the number of stations done and the total after each station.
+    '''
+    rows = []
+    nstations = len(locdfuse)
+    for k, (stationid, name, stnname) in enumerate(zip(locdfuse['LCTN_ID'],locdfuse['LCTN_NM'],locdfuse['DATA_COLUMN'])):
+        if stnname in df.columns:
+            bands = None if bandsfile is None else lookup_quantile_bands(bandsfile,stnname,onirange)
+            row = station_summary(pd,pivot(df,stnname),yearsuse,bands)
+            rows.append(dict(LCTN_ID=stationid,LCTN_NM=name,**row))
+        if progress is not None:
+            progress(k+1,nstations)
+    return rows
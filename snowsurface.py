@@ -0,0 +1,114 @@
+import io
+import numpy as np
+from PIL import Image
+from snowstations import great_circle_km
+
+'''
+Interpolated anomaly surface for the map, drawn as a raster tile layer under the station markers.
+
+The station values are detrended against station elevation, the residuals are spread onto a
+regular latitude/longitude grid by inverse distance weighting and the elevation trend is added
+back at a reference elevation (the median station elevation unless a grid of elevations is
+given). The weights come from one (grid cell x station) distance array, worked through in row
+blocks to bound memory. Cells further than SURFACE_MAX_DISTANCE_KM from every station with a
+value are left empty.
+
+The grid is coloured once and cut into 256 pixel web mercator (XYZ) tiles on request, so panning
+and zooming the map only resample the coloured grid.
+'''
+
+#The map's bounds and the grid spacing in degrees
+SURFACE_BOUNDS = {'west': -142., 'east': -110., 'south': 45., 'north': 61.}
+SURFACE_CELL_DEGREES = 0.1
+SURFACE_POWER = 2.
+SURFACE_MAX_DISTANCE_KM = 100.
+#Grid cells per block of the distance kernel
+SURFACE_BLOCK_CELLS = 8192
+TILE_SIZE = 256
+#plotly's RdBu, low values red and high values blue like the station markers
+SURFACE_COLOURS = np.array([
+    (103,0,31), (178,24,43), (214,96,77), (244,165,130), (253,219,199), (247,247,247),
+    (209,229,240), (146,197,222), (67,147,195), (33,102,172), (5,48,97),
+],dtype=float)
+SURFACE_OPACITY = 0.6
+
+def surface_grid(bounds=SURFACE_BOUNDS,cellsize=SURFACE_CELL_DEGREES):
+    #Latitudes and longitudes of the grid cell centres, south to north and west to east
+    lat = np.arange(bounds['south']+cellsize/2,bounds['north'],cellsize)
+    lon = np.arange(bounds['west']+cellsize/2,bounds['east'],cellsize)
+    return lat, lon
+
+def elevation_trend(values,elevation):
+    #Least squares slope and intercept of the values against elevation, flat with under 3 stations
+    if len(values) < 3 or np.ptp(elevation) == 0:
+        return 0., float(np.mean(values)) if len(values) else np.nan
+    slope, intercept = np.polyfit(elevation,values,1)
+    return slope, intercept
+
+def idw_surface(lat,lon,values,elevation,bounds=SURFACE_BOUNDS,cellsize=SURFACE_CELL_DEGREES,gridelevation=None,
+                power=SURFACE_POWER,maxdistkm=SURFACE_MAX_DISTANCE_KM):
+    '''
+    Interpolate the station values at lat, lon and elevation (m) onto the grid. gridelevation is
+    an optional (lat x lon) array of cell elevations; without it the surface is for the median
+    station elevation. Returns a (lat x lon) array, NaN where there is no station within maxdistkm.
+    '''
+    gridlat, gridlon = surface_grid(bounds,cellsize)
+    surface = np.full(len(gridlat)*len(gridlon),np.nan)
+    keep = np.isfinite(values) & np.isfinite(elevation)
+    if not keep.any():
+        return surface.reshape(len(gridlat),len(gridlon))
+    lat, lon, values, elevation = lat[keep], lon[keep], values[keep], elevation[keep]
+
+    slope, intercept = elevation_trend(values,elevation)
+    residuals = values-(intercept+slope*elevation)
+    if gridelevation is None:
+        cellelevation = np.full(surface.shape,np.median(elevation))
+    else:
+        cellelevation = np.asarray(gridelevation,dtype=float).ravel()
+
+    celllat = np.repeat(gridlat,len(gridlon))
+    celllon = np.tile(gridlon,len(gridlat))
+    for start in range(0,len(surface),SURFACE_BLOCK_CELLS):
+        block = slice(start,start+SURFACE_BLOCK_CELLS)
+        distances = great_circle_km(celllat[block,None],celllon[block,None],lat[None,:],lon[None,:])
+        #A cell on top of a station takes its value
+        weights = 1/np.maximum(distances,1e-3)**power
+        weights[distances > maxdistkm] = 0
+        totals = weights.sum(axis=1)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            surface[block] = (weights @ residuals)/totals
+    surface += intercept+slope*cellelevation
+    return surface.reshape(len(gridlat),len(gridlon))
+
+def surface_rgba(surface,cmin,cmax,colours=SURFACE_COLOURS,opacity=SURFACE_OPACITY):
+    #Colour the grid on a linear scale from cmin to cmax; empty cells are transparent
+    scaled = np.clip((surface-cmin)/(cmax-cmin),0,1)*(len(colours)-1)
+    lower = np.floor(np.nan_to_num(scaled)).astype(int).clip(0,len(colours)-2)
+    fraction = (np.nan_to_num(scaled)-lower)[...,None]
+    rgba = np.zeros(surface.shape+(4,),dtype=np.uint8)
+    rgba[...,0:3] = np.round(colours[lower]*(1-fraction)+colours[lower+1]*fraction)
+    rgba[...,3] = np.where(np.isnan(surface),0,round(255*opacity))
+    return rgba
+
+def tile_lonlat(z,x,y,size=TILE_SIZE):
+    #Longitudes of the pixel columns and latitudes of the pixel rows of XYZ tile (z, x, y)
+    ntiles = 2**z
+    lon = (x+(np.arange(size)+0.5)/size)/ntiles*360-180
+    lat = np.degrees(np.arctan(np.sinh(np.pi*(1-2*(y+(np.arange(size)+0.5)/size)/ntiles))))
+    return lon, lat
+
+def render_tile(rgba,z,x,y,bounds=SURFACE_BOUNDS,cellsize=SURFACE_CELL_DEGREES,size=TILE_SIZE):
+    '''
+    PNG bytes of XYZ tile (z, x, y) cut from the coloured grid by nearest cell. Pixels off the
+    grid are transparent.
+    '''
+    lon, lat = tile_lonlat(z,x,y,size)
+    rows = np.floor((lat-bounds['south'])/cellsize).astype(int)
+    cols = np.floor((lon-bounds['west'])/cellsize).astype(int)
+    rowok = (rows >= 0) & (rows < rgba.shape[0])
+    colok = (cols >= 0) & (cols < rgba.shape[1])
+    tile = np.zeros((size,size,4),dtype=np.uint8)
+    tile[np.ix_(rowok,colok)] = rgba[np.ix_(rows[rowok],cols[colok])]
+    buffer = io.BytesIO()
+    Image.fromarray(tile,'RGBA').save(buffer,format='PNG')
+    return buffer.getvalue()
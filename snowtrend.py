@@ -0,0 +1,85 @@
+import warnings
+import numpy as np
+from math import erfc, sqrt
+from pandas import DataFrame
+
+'''
+Long-term trends in the annual station series: the Theil-Sen slope with the Mann-Kendall test
+for its significance.
+
+Both are built from one array of every pair of years for every station at once. A station's
+slope is the median of its pairwise slopes and the Mann-Kendall S the sum of their signs, with
+pairs involving a missing year left out. The variance of S is corrected for tied values, which
+are counted from the sorted series by run length, and the two-sided p value comes from the
+normal approximation with continuity correction.
+'''
+
+#Fewer years with data than this leaves a station without a trend
+TREND_MIN_YEARS = 10
+
+def pairwise_differences(values,years):
+    #(station x pair) differences in value and in year over every pair of years i < j
+    first, second = np.triu_indices(len(years),k=1)
+    return values[:,second]-values[:,first], (years[second]-years[first]).astype(float)
+
+def sens_slope(values,years):
+    '''
+    Theil-Sen slope of each row of the (station x year) values, in units per year. NaN for
+    rows with fewer than TREND_MIN_YEARS values.
+    '''
+    valuediff, yeardiff = pairwise_differences(values,years)
+    with np.errstate(invalid='ignore'):
+        slopes = valuediff/yeardiff[None,:]
+    slope = np.full(len(values),np.nan)
+    enough = (~np.isnan(values)).sum(axis=1) >= TREND_MIN_YEARS
+    if enough.any():
+        slope[enough] = np.nanmedian(slopes[enough],axis=1)
+    return slope
+
+def tie_correction(values):
+    #Sum of t(t-1)(2t+5) over each row's groups of t tied values
+    nrows, ncols = values.shape
+    ordered = np.sort(values,axis=1)
+    present = ~np.isnan(ordered)
+    newrun = np.ones(ordered.shape,dtype=bool)
+    newrun[:,1:] = ordered[:,1:] != ordered[:,:-1]
+    runs = np.cumsum(newrun,axis=1)-1+ncols*np.arange(nrows)[:,None]
+    lengths = np.bincount(runs[present],minlength=nrows*ncols).reshape(nrows,ncols).astype(float)
+    return (lengths*(lengths-1)*(2*lengths+5)).sum(axis=1)
+
+def mann_kendall(values,years):
+    '''
+    Mann-Kendall S, Z and two-sided p value for each row of the (station x year) values. NaN
+    for rows with fewer than TREND_MIN_YEARS values.
+    '''
+    valuediff = pairwise_differences(values,years)[0]
+    s = np.nansum(np.sign(valuediff),axis=1)
+    n = (~np.isnan(values)).sum(axis=1).astype(float)
+    variance = (n*(n-1)*(2*n+5)-tie_correction(values))/18
+    with np.errstate(invalid='ignore',divide='ignore'):
+        z = np.where(s > 0,(s-1)/np.sqrt(variance),np.where(s < 0,(s+1)/np.sqrt(variance),0.))
+    z[(n < TREND_MIN_YEARS) | ~(variance > 0)] = np.nan
+    p = np.array([erfc(abs(value)/sqrt(2)) if np.isfinite(value) else np.nan for value in z])
+    return s, z, p
+
+def station_trends(annual,complete=None):
+    '''
+    Trend table for a (year x station) dataframe of annual values such as peak_annual_snow.
+    complete, shaped the same, marks the years to use. Returns a station x (slope, z, p,
+    nyears, median) dataframe, the slope in units per year and median that of the years used.
+    '''
+    values = annual.to_numpy(dtype=float).T.copy()
+    if complete is not None:
+        values[~complete.to_numpy(dtype=bool).T] = np.nan
+    years = annual.index.to_numpy(dtype=float)
+    s, z, p = mann_kendall(values,years)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore',category=RuntimeWarning)
+        median = np.nanmedian(values,axis=1)
+    return DataFrame({
+        'slope': sens_slope(values,years),
+        'z': z,
+        'p': p,
+        'nyears': (~np.isnan(values)).sum(axis=1),
+        'median': median,
+    },index=annual.columns)
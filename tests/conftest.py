@@ -0,0 +1,30 @@
+import os
+import sys
+
+#The app's modules sit at the top of the repository
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+import pytest
+from snowdata import hydrodoy_from_timestamp, wateryear_from_timestamps
+
+@pytest.fixture(scope='session')
+def snow_df():
+    '''
+    A small snow dataframe in the layout of prepare_snow_data: four stations over eight water
+    years of seasonal SWE with noise, gaps and a station that starts late.
+    '''
+    rng = np.random.default_rng(0)
+    dates = pd.date_range('2014-10-01','2022-09-30',freq='D')
+    season = np.clip(np.sin(2*np.pi*(dates.dayofyear.to_numpy()-280)/365),0,None)
+    columns = ['1A01P Alpha','2B02P Bravo','3C03P Charlie','4D04P Delta']
+    values = np.round(season[:,None]*rng.uniform(300,900,(len(dates),1))*rng.uniform(0.8,1.2,(1,len(columns)))+rng.normal(0,5,(len(dates),len(columns))),1)
+    values = np.clip(values,0,None)
+    values[rng.random(values.shape) < 0.02] = np.nan
+    values[0:800,3] = np.nan
+    df = pd.DataFrame(values,index=dates,columns=columns)
+    df['hydrodoy'] = hydrodoy_from_timestamp(df.index.to_series())
+    df['hydrological_year'] = wateryear_from_timestamps(df.index.to_series())
+    df['month-day'] = df.index.strftime('%m-%d')
+    return df.loc[~(df['month-day']=='02-29'),:]
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+from snowbands import BANDS_CACHE_STATIONS, build_quantile_bands, load_quantile_bands, lookup_quantile_bands
+from snowdata import build_year_bitsets, data_version, pivot_station_years, select_years_bitmask, years_from_bitmask
+from snowplot import MAXDAYIDX, TARGET_QUANTILES, complete_year_mask
+
+#Slider positions around, between and beyond the test ONI values
+ONI_RANGES = [[-3,3],[-3,-0.5],[-0.5,0.5],[0.5,3],[-1.2,0.8],[-0.4,-0.3],[1.5,3]]
+
+@pytest.fixture(scope='module')
+def teletable(snow_df):
+    years = np.unique(snow_df['hydrological_year'])
+    oni = np.round(np.random.default_rng(1).uniform(-2,2,len(years)),1)
+    return pd.DataFrame({'ONI': oni},index=years.astype(int))
+
+@pytest.fixture(scope='module')
+def bandsname(snow_df,teletable,tmp_path_factory):
+    stations = list(snow_df.columns[0:4])
+    filename = str(tmp_path_factory.mktemp('bands')/'bands.npz')
+    return build_quantile_bands(snow_df,stations,teletable['ONI'],filename)
+
+@pytest.fixture(scope='module')
+def bandsfile(snow_df,bandsname):
+    return load_quantile_bands(bandsname,data_version(snow_df))
+
+@pytest.mark.parametrize('onirange',ONI_RANGES)
+def test_bands_match_dataframe_quantile(snow_df,teletable,bandsfile,onirange):
+    oni = teletable['ONI']
+    for stnname in bandsfile['stations']:
+        subdf = pivot_station_years(snow_df,stnname)
+        completedf = subdf.loc[:,complete_year_mask(subdf,MAXDAYIDX)]
+        full, subset = lookup_quantile_bands(bandsfile,stnname,onirange)
+        expected = completedf.quantile(TARGET_QUANTILES,axis=1,interpolation='midpoint').transpose()
+        #Bands are stored to the nearest half millimetre
+        np.testing.assert_allclose(full,expected.to_numpy(dtype=float),atol=0.25)
+        inrange = oni.index[(oni > onirange[0]) & (oni < onirange[1])]
+        selected = completedf.loc[:,completedf.columns.isin(inrange)]
+        if selected.shape[1] == 0:
+            assert np.isnan(subset).all()
+            continue
+        expected = selected.quantile(TARGET_QUANTILES,axis=1,interpolation='midpoint').transpose()
+        np.testing.assert_allclose(subset,expected.to_numpy(dtype=float),atol=0.25)
+
+def test_bands_rejected_for_other_data(snow_df,bandsname):
+    assert load_quantile_bands(bandsname,data_version(snow_df.iloc[365:])) is None
+
+def test_station_arrays_cache_is_bounded(bandsfile):
+    for stnname in bandsfile['stations']:
+        lookup_quantile_bands(bandsfile,stnname,[-3,3])
+    info = bandsfile['read_station'].cache_info()
+    assert info.maxsize == BANDS_CACHE_STATIONS
+    assert info.currsize == len(bandsfile['stations'])
+
+@pytest.mark.parametrize('onirange',ONI_RANGES)
+def test_bitsets_match_pandas_filter(teletable,onirange):
+    bitsets = build_year_bitsets(teletable)
+    yearmask = select_years_bitmask(bitsets,{'ONI': onirange})
+    oni = teletable['ONI']
+    expected = oni.index[(oni > onirange[0]) & (oni < onirange[1])]
+    np.testing.assert_array_equal(years_from_bitmask(bitsets,yearmask),expected.to_numpy())
@@ -0,0 +1,35 @@
+import os
+import numpy as np
+import pytest
+from snowdata import INCH_MM, STATION_META_COLUMNS, combine_snow_sources, load_snotel_csv, snow_source, snow_source_names
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),'fixtures')
+
+def load_fixture():
+    return load_snotel_csv(os.path.join(FIXTURES,'snotel_swe.csv'),os.path.join(FIXTURES,'snotel_stations.csv'))
+
+def test_snotel_adapter_normalizes_fixture():
+    meta, swe, current = load_fixture()
+    assert list(meta.columns) == STATION_META_COLUMNS
+    #The station without an elevation is dropped from the metadata
+    assert meta['LCTN_ID'].to_list() == ['909:SNTL','515:SNTL']
+    assert meta['ELEVATION'].to_list() == [1295,1978]
+    assert (meta['NETWORK'] == 'SNOTEL').all()
+    assert swe.loc['2025-03-01','909:SNTL'] == pytest.approx(60.2*INCH_MM)
+    #Harts Pass has no data before the 2025 water year but reports in it
+    assert sorted(current) == ['1000:SNTL','515:SNTL','909:SNTL']
+
+def test_combine_snow_sources_keeps_stations_with_metadata_and_data():
+    meta, swe, current = combine_snow_sources([load_fixture()])
+    assert meta['LCTN_ID'].to_list() == ['515:SNTL','909:SNTL']
+    assert swe.columns.to_list() == meta['LCTN_ID'].to_list()
+    assert swe.index.is_monotonic_increasing
+    assert np.isnan(swe.loc['2024-03-01','515:SNTL'])
+    assert swe.loc['2024-12-01','515:SNTL'] == pytest.approx(10.2*INCH_MM)
+
+def test_snow_source_names_strip_spaces():
+    assert snow_source_names('BC ASWS, SNOTEL,') == ['BC ASWS','SNOTEL']
+
+def test_unknown_snow_source_lists_registered_names():
+    with pytest.raises(KeyError,match='BC ASWS'):
+        snow_source('Nowhere')
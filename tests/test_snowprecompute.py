@@ -0,0 +1,33 @@
+import pandas as pd
+from snowdata import data_version
+from snowprecompute import DERIVED_KEYS, EXTRA_COLUMNS, load_derived_data, precompute_derived, write_derived_data
+
+def assert_same_derived(left,right):
+    for key in DERIVED_KEYS:
+        if isinstance(left[key],pd.Series):
+            pd.testing.assert_series_equal(left[key],right[key])
+        else:
+            pd.testing.assert_frame_equal(left[key],right[key])
+
+def test_sharded_precompute_matches_serial(snow_df):
+    serial = precompute_derived(snow_df,workers=1)
+    sharded = precompute_derived(snow_df,workers=2)
+    assert set(DERIVED_KEYS) <= set(serial)
+    assert_same_derived(serial,sharded)
+
+def test_derived_data_round_trip(snow_df,tmp_path):
+    filename = str(tmp_path/'derived.pkl')
+    derived = precompute_derived(snow_df,workers=1)
+    write_derived_data(derived,data_version(snow_df),filename,str(tmp_path/'bands.npz'))
+    assert_same_derived(load_derived_data(filename,data_version(snow_df)),derived)
+
+def test_derived_data_rejected_for_other_stations_or_dates(snow_df,tmp_path):
+    filename = str(tmp_path/'derived.pkl')
+    write_derived_data(precompute_derived(snow_df,workers=1),data_version(snow_df),filename,str(tmp_path/'bands.npz'))
+    fewer_stations = snow_df.drop(columns=snow_df.columns[0])
+    shorter_record = snow_df.iloc[365:]
+    #Both end on the same date as the artifact's data
+    assert fewer_stations.index.max() == shorter_record.index.max() == snow_df.index.max()
+    assert load_derived_data(filename,data_version(fewer_stations)) is None
+    assert load_derived_data(filename,data_version(shorter_record)) is None
+    assert list(fewer_stations.columns[-len(EXTRA_COLUMNS):]) == EXTRA_COLUMNS